@@ -1,20 +1,31 @@
-from multiprocessing.pool import ThreadPool
+import hashlib
+from functools import partial
+from itertools import islice
 from zipfile import ZipFile, ZIP_STORED
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from django.db.models import Max
+from django.utils import timezone
 from flask import Blueprint, request, abort, json, Response
 
 # noinspection PyUnresolvedReferences
 from config import load_django
 
 from config.constants import (API_TIME_FORMAT, VOICE_RECORDING, ALL_DATA_STREAMS,
-    SURVEY_ANSWERS, SURVEY_TIMINGS, IMAGE_FILE)
+    SURVEY_ANSWERS, SURVEY_TIMINGS, IMAGE_FILE, CHUNK_TIMESLICE_QUANTUM, CHUNKABLE_FILES,
+    DOWNLOAD_COMPRESSION_LEVEL, DOWNLOAD_CONCURRENCY, DOWNLOAD_MAX_CONCURRENCY,
+    DOWNLOAD_MEMORY_BYTES)
 from database.models import is_object_id
 from database.data_access_models import ChunkRegistry, PipelineRegistry
 from database.study_models import Study
 from database.user_models import Participant, Researcher, StudyRelation
+from libs.concurrent_download import fetch_concurrently
+from libs.data_access_authentication import get_validated_access_key
+from libs.export_archives import get_export_archive, retrieve_export_archive
 from libs.s3 import s3_retrieve, s3_upload
+from libs.security import decode_base64, encode_base64
 from libs.streaming_bytes_io import StreamingBytesIO
+from libs.streaming_zip import deflate_for_zip, StreamingZipFile
 
 from database.data_access_models import PipelineUpload, InvalidUploadParameterError, \
     PipelineUploadTags
@@ -28,6 +39,11 @@ data_access_api = Blueprint('data_access_api', __name__)
 
 class DummyError(Exception): pass
 
+# A sync token download contains the chunks updated up to this many seconds before the request, more
+# recent chunks are left to the next download so that chunks still being saved are not skipped.
+SYNC_TOKEN_MARGIN_SECONDS = 60
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
 #########################################################################################
 
 def get_and_validate_study_id(chunked_download=False):
@@ -41,13 +57,18 @@ def get_and_validate_study_id(chunked_download=False):
     study = _get_study_or_abort_404(request.values.get('study_id', None),
                                     request.values.get('study_pk', None))
 
-    try:
-        # FIXME: this is an unsafe solution to identifying the exception to the raw data access rule
-        # for the batch user tasks. Update the researcher model to have a special flag.
-        r = Researcher.objects.get(access_key_id=request.values["access_key"])
-        override_for_batch = r.username.startswith("BATCH USER")
-    except Researcher.DoesNotExist:
-        override_for_batch = False
+    # FIXME: this is an unsafe solution to identifying the exception to the raw data access rule
+    # for the batch user tasks. Update the researcher model to have a special flag.
+    validated = get_validated_access_key(request.values["access_key"], request.values["secret_key"])
+    if validated is not None:
+        override_for_batch = validated[1]
+    else:
+        # (invalid credentials are rejected by get_and_validate_researcher)
+        try:
+            r = Researcher.objects.get(access_key_id=request.values["access_key"])
+            override_for_batch = r.username.startswith("BATCH USER")
+        except Researcher.DoesNotExist:
+            override_for_batch = False
 
     if not override_for_batch and not study.is_test and chunked_download:
         # You're only allowed to download chunked data from test studies
@@ -86,7 +107,7 @@ def _get_study_or_abort_404(study_object_id, study_pk):
 
 def get_and_validate_researcher(study):
     """
-    Finds researcher based on the secret key provided.
+    Finds researcher based on the secret key provided, returns their primary key.
     Returns 403 if researcher doesn't exist, is not credentialed on the study, or if
     the secret key does not match.
     """
@@ -94,18 +115,15 @@ def get_and_validate_researcher(study):
     access_key_id = request.values["access_key"]
     access_secret = request.values["secret_key"]
 
-    try:
-        researcher = Researcher.objects.get(access_key_id=access_key_id)
-    except Researcher.DoesNotExist:
-        return abort(403)  # access key DNE
+    validated = get_validated_access_key(access_key_id, access_secret)
+    if validated is None:
+        return abort(403)  # access key DNE, or incorrect secret key
 
-    if not StudyRelation.objects.filter(study_id=study.pk, researcher=researcher).exists():
+    researcher_pk, _, study_pks = validated
+    if study.pk not in study_pks:
         return abort(403)  # researcher is not credentialed for this study
 
-    if not researcher.validate_access_credentials(access_secret):
-        return abort(403)  # incorrect secret key
-
-    return researcher
+    return researcher_pk
 
 
 #########################################################################################
@@ -162,6 +180,23 @@ def get_data():
     JSON blobs: data streams, users - default to all
     Strings: date-start, date-end - format as "YYYY-MM-DDThh:mm:ss"
     optional: top-up = a file (registry.dat)
+    optional: sync_token - the sync token of the previous download (empty for the first download),
+        the download then only contains the chunks updated since that download.  The response
+        contains the sync token for the next download, as the X-Sync-Token header and as a file
+        named sync_token in the zip.  Use the same query parameters for every download of a sync.
+    optional: compress = "true" - the files in the zip are compressed (deflated).
+    optional: manifest - makes the download resumable, see get_manifest_files.  Provide it empty to
+        start a download, the response has its manifest token in the X-Manifest header.  To resume,
+        repeat the request with that token and manifest_offset = the number of (data) files already
+        received.  Optional: manifest_limit, the number of files to return (manifest_limit = 1
+        downloads a single file), and manifest_only = "true", which returns a json object of the
+        manifest token and the file names in the manifest, in order, instead of a download.
+    optional: trim_rows = "true" - the rows of the data files are restricted to time_start and
+        time_end (to the millisecond, inclusive), instead of the files being selected by hour.
+        Only the first and last hour of each participant's data stream are trimmed.  A trimmed
+        download contains no registry, the chunk hashes of a registry are of the whole chunks.
+    Downloads without a registry, sync_token, manifest or trim_rows may be served from an export
+    archive built ahead of time (see libs.export_archives), the zip then contains the same files.
     cases handled:
         missing creds or study, invalid researcher or study, researcher does not have access
         researcher creds are invalid
@@ -180,55 +215,149 @@ def get_data():
     determine_users_for_db_query(query)  # select users
     determine_time_range_for_db_query(query)  # construct time ranges
 
+    trim_range = None
+    if request.values.get("trim_rows", "").lower() == "true":
+        trim_range = determine_trim_range_for_db_query(query)
+
+    manifest = None
+    if "manifest" in request.values:
+        manifest = parse_manifest_token(request.values["manifest"])
+
+    sync_token = None
+    if "sync_token" in request.values:
+        # instead of a registry, the chunks updated since the last download are selected using the
+        # last_updated index.  (A resumed download uses the time range of the original.)
+        query['updated_after'] = parse_sync_token(request.values["sync_token"])
+        if manifest is not None and manifest["updated_until"] is not None:
+            query['updated_until'] = manifest["updated_until"]
+        else:
+            query['updated_until'] = timezone.now() - timedelta(seconds=SYNC_TOKEN_MARGIN_SECONDS)
+        sync_token = make_sync_token(query['updated_until'])
+
     # Do query (this is actually a generator)
-    if "registry" in request.values:
+    if sync_token is None and "registry" in request.values:
         get_these_files = handle_database_query(study.pk, query, registry=parse_registry(request.values["registry"]))
     else:
         get_these_files = handle_database_query(study.pk, query, registry=None)
 
+    if trim_range is not None and trim_range[0] is not None:
+        # the query starts at the hour of time_start, files that are not chunks are not trimmed.
+        get_these_files = get_these_files.exclude(
+            is_chunkable=False, time_bin__lt=EPOCH + timedelta(milliseconds=trim_range[0])
+        )
+
+    headers = {}
+    if "manifest" in request.values:
+        if manifest is None:
+            manifest = {
+                "max_pk": get_these_files.aggregate(Max("pk"))["pk__max"] or 0,
+                "updated_until": query.get('updated_until', None),
+                "query": get_query_digest(query, trim_range),
+            }
+        elif manifest["query"] != get_query_digest(query, trim_range):
+            print("the manifest does not match the query.")
+            return abort(400)
+        manifest_token = make_manifest_token(manifest)
+        get_these_files = get_manifest_files(get_these_files, manifest["max_pk"])
+
+        if request.values.get("manifest_only", "").lower() == "true":
+            return json.dumps({
+                "manifest": manifest_token,
+                "files": [determine_file_name(chunk) for chunk in get_these_files],
+            })
+
+        try:
+            offset = int(request.values.get("manifest_offset", 0))
+            limit = int(request.values.get("manifest_limit", 0)) or None
+        except ValueError:
+            return abort(400)
+        get_these_files = islice(get_these_files, offset, offset + limit if limit else None)
+        headers['X-Manifest'] = manifest_token
+
+    compress = request.values.get("compress", "").lower() == "true"
+    ordered = manifest is not None
+
     # If the request is from the web form we need to indicate that it is an attachment,
     # and don't want to create a registry file.
+    if 'web_form' in request.values:
+        headers['Content-Disposition'] = 'attachment; filename="data.zip"'
+
+    # Repeated downloads of data that no longer changes are served from an export archive, see
+    # libs.export_archives.
+    if (manifest is None and sync_token is None and trim_range is None
+            and "registry" not in request.values):
+        archive = get_export_archive(
+            study, query, construct_registry='web_form' not in request.values, compress=compress
+        )
+        if archive is not None:
+            return Response(retrieve_export_archive(archive, study), mimetype="zip", headers=headers)
+
     # Oddly, it is the presence of  mimetype=zip that causes the streaming response to actually stream.
     if 'web_form' in request.values:
         return Response(
-            zip_generator(get_these_files, construct_registry=False),
+            zip_generator(get_these_files, study, construct_registry=False, compress=compress, ordered=ordered,
+                          trim_range=trim_range),
             mimetype="zip",
-            headers={'Content-Disposition': 'attachment; filename="data.zip"'}
+            headers=headers,
+        )
+    elif sync_token is not None:
+        headers['X-Sync-Token'] = sync_token
+        return Response(
+                zip_generator(get_these_files, study, sync_token=sync_token, compress=compress, ordered=ordered,
+                              trim_range=trim_range),
+                mimetype="zip",
+                headers=headers,
         )
     else:
+        # the registry of a trimmed download would register chunks that it did not contain in full.
         return Response(
-                zip_generator(get_these_files, construct_registry=True),
+                zip_generator(get_these_files, study, construct_registry=trim_range is None,
+                              compress=compress, ordered=ordered, trim_range=trim_range),
                 mimetype="zip",
+                headers=headers,
         )
 
 
 # from libs.security import generate_random_string
 
 # Note: you cannot access the request context inside a generator function
-def zip_generator(files_list, construct_registry=False):
+def zip_generator(files_list, study, construct_registry=False, sync_token=None, compress=False,
+                  ordered=False, trim_range=None):
     """ Pulls in data from S3 in a multithreaded network operation, constructs a zip file of that
     data. This is a generator, advantage is it starts returning data (file by file, but wrapped
-    in zip compression) almost immediately. """
+    in zip compression) almost immediately.  All of the files belong to the study.
+    If compress is set the files are compressed on the download threads (in parallel), and written
+    to the zip already compressed.  If ordered is set the files are written in the order of
+    files_list (resumable downloads need this), otherwise in the order they are fetched.
+    If a trim_range is provided the chunks are trimmed to it, see trim_chunk_rows; do not construct
+    a registry then, its chunk hashes are of the whole chunks. """
 
     processed_files = set()
     duplicate_files = set()
-    pool = ThreadPool(3)
-    # 3 Threads has been heuristically determined to be a good value, it does not cause the server
-    # to be overloaded, and provides more-or-less the maximum data download speed.  This was tested
-    # on an m4.large instance (dual core, 8GB of ram).
     file_registry = {}
 
     zip_output = StreamingBytesIO()
-    zip_input = ZipFile(zip_output, mode="w", compression=ZIP_STORED, allowZip64=True)
+    zip_input = StreamingZipFile(zip_output, mode="w", compression=ZIP_STORED, allowZip64=True)
     # random_id = generate_random_string()[:32]
     # print "returning data for query %s" % random_id
+
+    # chunks_and_content is a generator of tuples, of the chunk and the content of the file.
+    # The number of files fetched at once is DOWNLOAD_CONCURRENCY (3 was heuristically determined
+    # on an m4.large instance), or adapts (see libs.concurrent_download).
+    # the study's object id and key are handed to the threads, so they make no queries.
+    retrieve = partial(batch_retrieve_s3, study_object_id=study.object_id,
+                       encryption_key=study.encryption_key.encode(),
+                       compression_level=DOWNLOAD_COMPRESSION_LEVEL if compress else None,
+                       trim_range=trim_range)
+    # The file_size of a chunk is only a lower bound on the size of its contents: for chunks
+    # registered before ChunkBuffers it is the size of the compressed csv.
+    chunks_and_content = fetch_concurrently(
+        retrieve, files_list, retrieved_size,
+        DOWNLOAD_CONCURRENCY, max_concurrency=DOWNLOAD_MAX_CONCURRENCY,
+        memory_limit=DOWNLOAD_MEMORY_BYTES, expected_size=lambda chunk: chunk["file_size"],
+        ordered=ordered,
+    )
     try:
-        # chunks_and_content is a list of tuples, of the chunk and the content of the file.
-        # chunksize (which is a keyword argument of imap, not to be confused with Beiwe Chunks)
-        # is the size of the batches that are handed to the pool. We always want to add the next
-        # file to retrieve to the pool asap, so we want a chunk size of 1.
-        # (In the documentation there are comments about the timeout, it is irrelevant under this construction.)
-        chunks_and_content = pool.imap_unordered(batch_retrieve_s3, files_list, chunksize=1)
         total_size = 0
         for chunk, file_contents in chunks_and_content:
             if construct_registry:
@@ -239,7 +368,10 @@ def zip_generator(files_list, construct_registry=False):
                 continue
             processed_files.add(file_name)
             # print file_name
-            zip_input.writestr(file_name, file_contents)
+            if compress:
+                zip_input.write_deflated(file_name, *file_contents)
+            else:
+                zip_input.writestr(file_name, file_contents)
             # These can be large, and we don't want them sticking around in memory as we wait for the yield
             del file_contents, chunk
             # print len(zip_output)
@@ -255,20 +387,24 @@ def zip_generator(files_list, construct_registry=False):
             yield zip_output.getvalue()
             zip_output.empty()
 
+        if sync_token is not None:
+            zip_input.writestr("sync_token", sync_token)
+            yield zip_output.getvalue()
+            zip_output.empty()
+
         # close, then yield all remaining data in the zip.
         zip_input.close()
         yield zip_output.getvalue()
 
     except DummyError:
-        # The try-except-finally block is here to guarantee the Threadpool is closed and terminated.
+        # The try-except-finally block is here to guarantee the fetching threads are shut down.
         # we don't handle any errors, we just re-raise any error that shows up.
         # (with statement does not work.)
         raise
     finally:
-        # We rely on the finally block to ensure that the threadpool will be closed and terminated,
+        # We rely on the finally block to ensure that the fetching threads will be shut down,
         # and also to print an error to the log if we need to.
-        pool.close()
-        pool.terminate()
+        chunks_and_content.close()
         # if duplicate_files:
         #     duplcate_file_message = "encountered duplicate files: %s" % ",".join(
         #             str(name_path) for name_path in duplicate_files)
@@ -292,6 +428,73 @@ def parse_registry(reg_dat):
     return ret
 
 
+def make_sync_token(updated_until: datetime) -> str:
+    """ Sync tokens are opaque to clients, they contain the last_updated time up to which chunks
+    were included in a download (as microseconds since the epoch). """
+    microseconds = (updated_until - EPOCH) // timedelta(microseconds=1)
+    return encode_base64(json.dumps({"v": 1, "updated_until": microseconds}).encode()).decode()
+
+
+def parse_sync_token(sync_token: str):
+    """ Returns the time in the sync token, None for an empty token (the first download of a sync).
+    Invalid tokens cause a 400 error. """
+    if not sync_token:
+        return None
+    try:
+        return EPOCH + timedelta(microseconds=json.loads(decode_base64(sync_token.encode()))["updated_until"])
+    except Exception:
+        print("invalid sync token")
+        return abort(400)
+
+
+def get_manifest_files(chunks, max_pk: int):
+    """ The manifest of a resumable download is the chunks of its query, in primary key order, up to
+    the largest primary key when the download started (so chunks created later do not shift the
+    offsets), without chunks whose file name in the zip duplicates an earlier one's (these would be
+    skipped by zip_generator).  Each file in the download is then at a fixed offset, and a resumed
+    download starts at an offset without fetching the files before it.
+    (The contents of a chunk updated in the meantime are its new contents.) """
+    file_names = set()
+    for chunk in chunks.filter(pk__lte=max_pk).order_by("pk").iterator():
+        file_name = determine_file_name(chunk)
+        if file_name not in file_names:
+            file_names.add(file_name)
+            yield chunk
+
+
+def get_query_digest(query: dict, trim_range=None) -> str:
+    """ Identifies a download query, so a manifest can only be used with the query it came from. """
+    if trim_range is not None:
+        query = dict(query, trim_range=trim_range)
+    return hashlib.sha256(json.dumps(query, sort_keys=True, default=str).encode()).hexdigest()[:32]
+
+
+def make_manifest_token(manifest: dict) -> str:
+    """ Manifest tokens are opaque to clients, see make_sync_token. """
+    updated_until = manifest["updated_until"]
+    if updated_until is not None:
+        updated_until = (updated_until - EPOCH) // timedelta(microseconds=1)
+    return encode_base64(json.dumps({
+        "v": 1, "max_pk": manifest["max_pk"], "updated_until": updated_until, "query": manifest["query"]
+    }).encode()).decode()
+
+
+def parse_manifest_token(manifest_token: str):
+    """ Returns the manifest in the token, None for an empty token (a new manifest).
+    Invalid tokens cause a 400 error. """
+    if not manifest_token:
+        return None
+    try:
+        manifest = json.loads(decode_base64(manifest_token.encode()))
+        if manifest["updated_until"] is not None:
+            manifest["updated_until"] = EPOCH + timedelta(microseconds=manifest["updated_until"])
+        return {"max_pk": int(manifest["max_pk"]), "updated_until": manifest["updated_until"],
+                "query": manifest["query"]}
+    except Exception:
+        print("invalid manifest token")
+        return abort(400)
+
+
 def determine_file_name(chunk):
     """ Generates the correct file name to provide the file with in the zip file.
         (This also includes the folder location files in the zip.) """
@@ -342,11 +545,66 @@ def str_to_datetime(time_string):
             return abort(400)
 
 
-def batch_retrieve_s3(chunk):
-    """ Data is returned in the form (chunk_object, file_data). """
-    return chunk, s3_retrieve(chunk["chunk_path"],
-                              study_object_id=Study.objects.get(id=chunk["study_id"]).object_id,
-                              raw_path=True)
+def batch_retrieve_s3(chunk, study_object_id, encryption_key, compression_level=None,
+                      trim_range=None):
+    """ Data is returned in the form (chunk_object, file_data).  If a compression_level is provided
+    file_data is the (compressed data, crc, size) of libs.streaming_zip.deflate_for_zip.  If a
+    trim_range is provided chunks that are not entirely within it are trimmed to it. """
+    file_data = s3_retrieve(chunk["chunk_path"],
+                            study_object_id=study_object_id,
+                            raw_path=True,
+                            encryption_key=encryption_key)
+    if trim_range is not None and chunk["data_type"] in CHUNKABLE_FILES:
+        bin_start = (chunk["time_bin"] - EPOCH) // timedelta(milliseconds=1)
+        bin_end = bin_start + CHUNK_TIMESLICE_QUANTUM * 1000 - 1
+        start, end = trim_range
+        if (start is not None and start > bin_start) or (end is not None and end < bin_end):
+            file_data = trim_chunk_rows(file_data, start, end)
+    if compression_level is not None:
+        return chunk, deflate_for_zip(file_data, compression_level)
+    return chunk, file_data
+
+
+def trim_chunk_rows(file_data: bytes, start=None, end=None) -> bytes:
+    """ Returns the chunk with only the rows whose timestamps (unix milliseconds, the first column)
+    are from start to end, inclusive.  The rows of a chunk are sorted by timestamp, so the first
+    and last rows are found by binary search and the chunk is not parsed.  A chunk that cannot be
+    searched is returned untouched. """
+    header_end = file_data.find(b"\n")
+    if header_end == -1:
+        return file_data
+    try:
+        first = header_end + 1 if start is None else find_chunk_row(file_data, header_end + 1, start)
+        last = len(file_data) if end is None else find_chunk_row(file_data, first, end + 1)
+    except ValueError:
+        print("could not trim a chunk, the timestamp of a row is invalid")
+        return file_data
+    # last is the start of a row or the end of the file, the newline before it is not included.
+    rows = file_data[first:last].rstrip(b"\n")
+    return file_data[:header_end] + b"\n" + rows if rows else file_data[:header_end]
+
+
+def find_chunk_row(file_data: bytes, low: int, timestamp: int) -> int:
+    """ Binary search over the rows of a chunk from the row starting at low, returns the offset of
+    the first row with a timestamp of at least timestamp, or the end of the file. """
+    high = len(file_data)
+    # the rows before low have earlier timestamps, the rows from high on do not.
+    while low < high:
+        row_start = file_data.rfind(b"\n", low, (low + high) // 2) + 1 or low
+        row_end = file_data.find(b"\n", row_start)
+        if row_end == -1:
+            row_end = len(file_data)
+        if int(file_data[row_start:row_end].split(b",", 1)[0]) < timestamp:
+            low = min(row_end + 1, len(file_data))
+        else:
+            high = row_start
+    return low
+
+
+def retrieved_size(chunk_and_file_data) -> int:
+    """ The size of the file data returned by batch_retrieve_s3. """
+    file_data = chunk_and_file_data[1]
+    return len(file_data[0]) if isinstance(file_data, tuple) else len(file_data)
 
 
 #########################################################################################
@@ -400,12 +658,28 @@ def determine_time_range_for_db_query(query):
         query['end'] = str_to_datetime(request.values['time_end'])
 
 
+def determine_trim_range_for_db_query(query):
+    """ Returns the time range of the query as (start, end) in unix milliseconds (either can be
+    None), for trim_chunk_rows, or None if the query has no time range.  The query is changed to
+    start at the hour of the start (the time_bin of the chunk containing it). """
+    if 'start' not in query and 'end' not in query:
+        return None
+    start = end = None
+    if 'start' in query:
+        start = (query['start'].replace(tzinfo=timezone.utc) - EPOCH) // timedelta(milliseconds=1)
+        query['start'] = query['start'].replace(minute=0, second=0, microsecond=0)
+    if 'end' in query:
+        end = (query['end'].replace(tzinfo=timezone.utc) - EPOCH) // timedelta(milliseconds=1)
+    return start, end
+
+
 def handle_database_query(study_id, query, registry=None):
     """
     Runs the database query and returns a QuerySet.
     """
     chunk_fields = ["pk", "participant_id", "data_type", "chunk_path", "time_bin", "chunk_hash",
-                    "participant__patient_id", "study_id", "survey_id", "survey__object_id"]
+                    "participant__patient_id", "study_id", "survey_id", "survey__object_id",
+                    "file_size"]
 
     chunks = ChunkRegistry.get_chunks_time_range(study_id, **query)
 
@@ -566,23 +840,24 @@ def pipeline_data_download():
 
     ####################################
     return Response(
-            zip_generator_for_pipeline(query),
+            zip_generator_for_pipeline(query, study_obj),
             mimetype="zip",
             headers={'Content-Disposition': 'attachment; filename="data.zip"'}
     )
 
 #TODO: This is a trivial rewrite of the other zip generator function for minor differences. refactor when you get to django.
-def zip_generator_for_pipeline(files_list):
-    pool = ThreadPool(3)
+def zip_generator_for_pipeline(files_list, study):
     zip_output = StreamingBytesIO()
     zip_input = ZipFile(zip_output, mode="w", compression=ZIP_STORED, allowZip64=True)
+    # chunks_and_content is a generator of tuples, of the pipeline upload and the content of the file.
+    retrieve = partial(batch_retrieve_pipeline_s3, study_object_id=study.object_id,
+                       encryption_key=study.encryption_key.encode())
+    chunks_and_content = fetch_concurrently(
+        retrieve, files_list, lambda upload_and_content: len(upload_and_content[1]),
+        DOWNLOAD_CONCURRENCY, max_concurrency=DOWNLOAD_MAX_CONCURRENCY,
+        memory_limit=DOWNLOAD_MEMORY_BYTES,
+    )
     try:
-        # chunks_and_content is a list of tuples, of the chunk and the content of the file.
-        # chunksize (which is a keyword argument of imap, not to be confused with Beiwe Chunks)
-        # is the size of the batches that are handed to the pool. We always want to add the next
-        # file to retrieve to the pool asap, so we want a chunk size of 1.
-        # (In the documentation there are comments about the timeout, it is irrelevant under this construction.)
-        chunks_and_content = pool.imap_unordered(batch_retrieve_pipeline_s3, files_list, chunksize=1)
         for pipeline_upload, file_contents in chunks_and_content:
             # file_name = determine_file_name(chunk)
             zip_input.writestr("data/" + pipeline_upload.file_name, file_contents)
@@ -596,23 +871,22 @@ def zip_generator_for_pipeline(files_list):
         yield zip_output.getvalue()
     
     except DummyError:
-        # The try-except-finally block is here to guarantee the Threadpool is closed and terminated.
+        # The try-except-finally block is here to guarantee the fetching threads are shut down.
         # we don't handle any errors, we just re-raise any error that shows up.
         # (with statement does not work.)
         raise
     finally:
-        # We rely on the finally block to ensure that the threadpool will be closed and terminated,
+        # We rely on the finally block to ensure that the fetching threads will be shut down,
         # and also to print an error to the log if we need to.
-        pool.close()
-        pool.terminate()
+        chunks_and_content.close()
         
         
-def batch_retrieve_pipeline_s3(pipeline_upload):
+def batch_retrieve_pipeline_s3(pipeline_upload, study_object_id, encryption_key):
     """ Data is returned in the form (chunk_object, file_data). """
-    study = Study.objects.get(id = pipeline_upload.study_id)
     return pipeline_upload, s3_retrieve(pipeline_upload.s3_path,
-                                        study.object_id,
-                                        raw_path=True)
+                                        study_object_id,
+                                        raw_path=True,
+                                        encryption_key=encryption_key)
 
 
 # class dummy_threadpool():
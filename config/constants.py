@@ -12,14 +12,48 @@ from config.settings import DOMAIN_NAME
 ## Networking
 #This value is used in libs.s3, does what it says.
 DEFAULT_S3_RETRIES = getenv("DEFAULT_S3_RETRIES") or 3
+#Used in data downloads (the data access api), the number of files fetched from s3 at once.  If
+# DOWNLOAD_MAX_CONCURRENCY is greater the number adapts to the observed throughput, up to that many.
+# The files being fetched for a download are limited to DOWNLOAD_MEMORY_BYTES (approximately).
+DOWNLOAD_CONCURRENCY = int(getenv("DOWNLOAD_CONCURRENCY") or 3)
+DOWNLOAD_MAX_CONCURRENCY = int(getenv("DOWNLOAD_MAX_CONCURRENCY") or 0)
+DOWNLOAD_MEMORY_BYTES = int(getenv("DOWNLOAD_MEMORY_BYTES") or 256*1024*1024)
+#Used in data downloads that request compression, the zlib compression level (1-9) of the files.
+DOWNLOAD_COMPRESSION_LEVEL = int(getenv("DOWNLOAD_COMPRESSION_LEVEL") or 6)
+#Used in data downloads, see libs.export_archives.  A download is built as an export archive once
+# it has been requested EXPORT_ARCHIVE_MIN_REQUESTS times (with no gap of EXPORT_ARCHIVE_REQUEST_DAYS
+# between requests) and its data has not changed for EXPORT_ARCHIVE_QUIET_HOURS (data collection has
+# finished).  Archives that have not been requested for EXPORT_ARCHIVE_REQUEST_DAYS are deleted.
+EXPORT_ARCHIVE_MIN_REQUESTS = int(getenv("EXPORT_ARCHIVE_MIN_REQUESTS") or 2)
+EXPORT_ARCHIVE_QUIET_HOURS = int(getenv("EXPORT_ARCHIVE_QUIET_HOURS") or 24)
+EXPORT_ARCHIVE_REQUEST_DAYS = int(getenv("EXPORT_ARCHIVE_REQUEST_DAYS") or 30)
 
 ## File processing directives
 #NOTE: these numbers were determined through trial and error on a C4 Large AWS instance.
 #Used in data download and data processing, base this on CPU core count.
 CONCURRENT_NETWORK_OPS = getenv("CONCURRENT_NETWORK_OPS") or 10
+#Used in file processing, the number of processes that csv parsing and merging are spread over.  0
+# (the default) does that work on threads of the processing process, where it is limited to one core.
+# The pool is created for each processing task (by each celery worker process), so reduce the worker
+# concurrency to match.
+FILE_PROCESS_CPU_PROCESSES = int(getenv("FILE_PROCESS_CPU_PROCESSES") or 0)
 #Used in file processing, number of files to be pulled in and processed simultaneously.
 # Higher values reduce s3 usage, reduce processing time, but increase ram requirements.
 FILE_PROCESS_PAGE_SIZE = getenv("FILE_PROCESS_PAGE_SIZE") or 250
+#Used in file processing, the number of threads running each stage of the file processing pipeline
+# (see libs.staged_pipeline), and the number of items that may wait between one stage and the next.
+# Downloading and uploading are network bound, decryption and parsing are cpu bound.
+FILE_PROCESS_DOWNLOAD_CONCURRENCY = int(getenv("FILE_PROCESS_DOWNLOAD_CONCURRENCY") or 10)
+FILE_PROCESS_DECRYPT_CONCURRENCY = int(getenv("FILE_PROCESS_DECRYPT_CONCURRENCY") or 2)
+FILE_PROCESS_PARSE_CONCURRENCY = int(getenv("FILE_PROCESS_PARSE_CONCURRENCY") or 1)
+FILE_PROCESS_MERGE_CONCURRENCY = int(getenv("FILE_PROCESS_MERGE_CONCURRENCY") or 4)
+FILE_PROCESS_UPLOAD_CONCURRENCY = int(getenv("FILE_PROCESS_UPLOAD_CONCURRENCY") or 10)
+FILE_PROCESS_QUEUE_SIZE = int(getenv("FILE_PROCESS_QUEUE_SIZE") or 20)
+#Used in file processing, merged chunks wait for upload in ChunkBuffers (see libs.chunk_buffer).  While
+# all the ChunkBuffers of a process hold more than CHUNK_BUFFER_MEMORY_BYTES they compress what is
+# written to them, a ChunkBuffer holding more than CHUNK_BUFFER_SPILL_BYTES moves to a temporary file.
+CHUNK_BUFFER_MEMORY_BYTES = int(getenv("CHUNK_BUFFER_MEMORY_BYTES") or 1024*1024*1024)
+CHUNK_BUFFER_SPILL_BYTES = int(getenv("CHUNK_BUFFER_SPILL_BYTES") or 128*1024*1024)
 
 #This string will be printed into non-error hourly reports to improve error filtering.
 DATA_PROCESSING_NO_ERROR_STRING = getenv("DATA_PROCESSING_NO_ERROR_STRING") or "2HEnBwlawY"
@@ -28,6 +62,44 @@ DATA_PROCESSING_NO_ERROR_STRING = getenv("DATA_PROCESSING_NO_ERROR_STRING") or "
 # (this is not a timeout, it only invalidates tasks that have not yet run.)
 CELERY_EXPIRY_MINUTES = getenv("CELERY_EXPIRY_MINUTES") or 14
 CELERY_ERROR_REPORT_TIMEOUT_SECONDS = getenv("CELERY_ERROR_REPORT_TIMEOUT_SECONDS") or 60*15
+# The number of seconds a participant's processing lease lasts without being renewed.  Leases are
+# renewed (heartbeat) three times per lease period while the participant is being processed, a lease
+# that is not renewed (e.g. the worker died) can be taken over once it expires.
+FILE_PROCESS_LEASE_SECONDS = int(getenv("FILE_PROCESS_LEASE_SECONDS") or 60*5)
+# Used by the continuous file processing scheduler (services/celery_data_processing.py --scheduler).
+# How often the scheduler queues participants, the number of participants it keeps queued or running
+# per celery worker, and the number of minutes after which a queued task that has not started is
+# revoked and its participant queued again.
+FILE_PROCESS_SCHEDULER_INTERVAL_SECONDS = int(getenv("FILE_PROCESS_SCHEDULER_INTERVAL_SECONDS") or 30)
+FILE_PROCESS_TASKS_PER_WORKER = int(getenv("FILE_PROCESS_TASKS_PER_WORKER") or 2)
+FILE_PROCESS_STRAGGLER_MINUTES = int(getenv("FILE_PROCESS_STRAGGLER_MINUTES") or 10)
+
+## Caches
+# Study encryption keys are cached in every process, entries expire after this many seconds.
+STUDY_KEY_CACHE_SECONDS = int(getenv("STUDY_KEY_CACHE_SECONDS") or 60*60)
+# Set to "false" to stop celery data processing workers from loading every study encryption key
+# into that cache when they start.
+PRELOAD_STUDY_KEYS_ON_WORKER_START = (getenv("PRELOAD_STUDY_KEYS_ON_WORKER_START") or "true").lower() == "true"
+# Participant private keys (parsed) are cached for the upload endpoint, this many per process, each
+# for at most this many seconds.
+CLIENT_KEY_CACHE_SIZE = int(getenv("CLIENT_KEY_CACHE_SIZE") or 10000)
+CLIENT_KEY_CACHE_SECONDS = int(getenv("CLIENT_KEY_CACHE_SECONDS") or 60*60)
+# The AES keys of device files, unwrapped with the participant's private key, are cached for the
+# upload endpoint, this many per process.
+DEVICE_KEY_CACHE_SIZE = int(getenv("DEVICE_KEY_CACHE_SIZE") or 50000)
+# Participant credentials that passed verification on the mobile endpoints are cached, this many per
+# process, each for at most this many seconds.
+PARTICIPANT_CREDENTIAL_CACHE_SIZE = int(getenv("PARTICIPANT_CREDENTIAL_CACHE_SIZE") or 100000)
+PARTICIPANT_CREDENTIAL_CACHE_SECONDS = int(getenv("PARTICIPANT_CREDENTIAL_CACHE_SECONDS") or 5*60)
+# Researcher access keys that passed validation on the data access api are cached, along with the
+# studies the researcher has access to, this many per process, each for at most this many seconds.
+ACCESS_KEY_CACHE_SIZE = int(getenv("ACCESS_KEY_CACHE_SIZE") or 1000)
+ACCESS_KEY_CACHE_SECONDS = int(getenv("ACCESS_KEY_CACHE_SECONDS") or 5*60)
+
+## Device uploads
+# On staging servers lines of uploaded files that fail to decrypt are recorded as LineEncryptionErrors,
+# at most this many per file (a random sample of the lines when there are more).
+LINE_ENCRYPTION_ERRORS_PER_FILE = int(getenv("LINE_ENCRYPTION_ERRORS_PER_FILE") or 100)
 
 
 ## Data streams and survey types ##
@@ -92,6 +164,8 @@ CHUNK_TIMESLICE_QUANTUM = 3600
 # the name of the s3 folder that contains chunked data
 CHUNKS_FOLDER = "CHUNKED_DATA"
 PIPELINE_FOLDER = "PIPELINE_DATA"
+# the name of the s3 folder (in each study's folder) that contains export archives
+EXPORT_ARCHIVES_FOLDER = "export_archives"
 
 ## Constants for for the keys in data_stream_to_s3_file_name_string
 ACCELEROMETER = "accelerometer"
@@ -1,10 +1,15 @@
 import json
 import random
 import string
-from datetime import datetime
+from datetime import datetime, timedelta
+from os import getpid
+from socket import gethostname
 from time import sleep
+from typing import Iterable, Optional, Tuple
+from uuid import uuid4
 
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, Value, When
 from django.utils import timezone
 from django_extensions.db.fields.json import JSONField
 
@@ -66,12 +71,25 @@ class ChunkRegistry(AbstractModel):
 
     @classmethod
     def register_chunked_data(cls, data_type, time_bin, chunk_path, file_contents, study_id,
-                              participant_id, survey_id=None):
-        
+                              participant_id, survey_id=None, file_size=None):
+        """ file_contents is the chunk's csv, its hash is the chunk hash.  file_size is the size of
+            the file as stored on s3 (encrypted), if it is not provided the csv's size is used. """
+        cls.build_chunked_data(
+            data_type, time_bin, chunk_path, file_contents, study_id, participant_id, survey_id,
+            file_size
+        ).save()
+
+    @classmethod
+    def build_chunked_data(cls, data_type, time_bin, chunk_path, file_contents, study_id,
+                           participant_id, survey_id=None, file_size=None, chunk_hash_str=None):
+        """ As register_chunked_data, but the ChunkRegistry is returned unsaved (see bulk_register).
+            Callers that hashed the contents already (libs.security.encode_chunk_hash) provide the
+            chunk_hash_str and file_size instead of the file_contents. """
         if data_type not in CHUNKABLE_FILES:
             raise UnchunkableDataTypeError
 
-        chunk_hash_str = chunk_hash(file_contents).decode()
+        if chunk_hash_str is None:
+            chunk_hash_str = chunk_hash(file_contents).decode()
         
         time_bin = int(time_bin) * CHUNK_TIMESLICE_QUANTUM
         time_bin = timezone.make_aware(datetime.utcfromtimestamp(time_bin), timezone.utc)
@@ -85,7 +103,7 @@ class ChunkRegistry(AbstractModel):
         # timezone so it should be generalizable) is to add UTC as a timezone when storing a naive
         # datetime in the database.
         
-        cls.objects.create(
+        return cls(
             is_chunkable=True,
             chunk_path=chunk_path,
             chunk_hash=chunk_hash_str,
@@ -94,8 +112,37 @@ class ChunkRegistry(AbstractModel):
             study_id=study_id,
             participant_id=participant_id,
             survey_id=survey_id,
-            file_size=len(file_contents),
+            file_size=len(file_contents) if file_size is None else file_size,
         )
+
+    @classmethod
+    def bulk_register(cls, new_chunks: list, updated_chunks: list):
+        """ Saves unsaved ChunkRegistries (see build_chunked_data), and the chunk_hash and file_size
+            of existing ones, with two queries in a single transaction. """
+        with transaction.atomic():
+            if new_chunks:
+                cls.objects.bulk_create(new_chunks)
+            if updated_chunks:
+                # (Django 1.11 has no bulk_update, this is what it does.)
+                cls.objects.filter(pk__in=[chunk.pk for chunk in updated_chunks]).update(
+                    chunk_hash=Case(
+                        *[When(pk=chunk.pk, then=Value(chunk.chunk_hash)) for chunk in updated_chunks],
+                        output_field=models.CharField()
+                    ),
+                    file_size=Case(
+                        *[When(pk=chunk.pk, then=Value(chunk.file_size)) for chunk in updated_chunks],
+                        output_field=models.IntegerField()
+                    ),
+                    last_updated=timezone.now(),
+                )
+
+    @classmethod
+    def get_by_chunk_paths(cls, chunk_paths) -> dict:
+        """ Returns a dict of chunk path: list of the ChunkRegistries with that path, one query. """
+        chunks = {}
+        for chunk in cls.objects.filter(chunk_path__in=chunk_paths):
+            chunks.setdefault(chunk.chunk_path, []).append(chunk)
+        return chunks
     
     @classmethod
     def register_unchunked_data(cls, data_type, unix_timestamp, chunk_path, study_id, participant_id,
@@ -119,11 +166,14 @@ class ChunkRegistry(AbstractModel):
         )
 
     @classmethod
-    def get_chunks_time_range(cls, study_id, user_ids=None, data_types=None, start=None, end=None):
+    def get_chunks_time_range(cls, study_id, user_ids=None, data_types=None, start=None, end=None,
+                              updated_after=None, updated_until=None):
         """
         This function uses Django query syntax to provide datetimes and have Django do the
         comparison operation, and the 'in' operator to have Django only match the user list
         provided.
+        updated_after and updated_until restrict the chunks to those last updated in that range
+        (used by data access api sync tokens).
         """
 
         query = {'study_id': study_id}
@@ -135,10 +185,14 @@ class ChunkRegistry(AbstractModel):
             query['time_bin__gte'] = start
         if end:
             query['time_bin__lte'] = end
+        if updated_after:
+            query['last_updated__gt'] = updated_after
+        if updated_until:
+            query['last_updated__lte'] = updated_until
         return cls.objects.filter(**query)
 
     def update_chunk_hash(self, data_to_hash):
-        self.chunk_hash = chunk_hash(data_to_hash)
+        self.chunk_hash = chunk_hash(data_to_hash).decode()
         self.save()
 
     @classmethod
@@ -158,15 +212,53 @@ class FileToProcess(AbstractModel):
     study = models.ForeignKey('Study', on_delete=models.PROTECT, related_name='files_to_process')
     participant = models.ForeignKey('Participant', on_delete=models.PROTECT, related_name='files_to_process')
 
+    # Study object ids and primary keys never change, so they are cached for the life of the
+    # process. {study object id: study pk}
+    study_pks = {}
+
     @classmethod
     def append_file_for_processing(cls, file_path, study_object_id, **kwargs):
-        # Get the study's primary key
-        study_pk = Study.objects.filter(object_id=study_object_id).values_list('pk', flat=True).get()
-        
+        cls.objects.create(
+            s3_file_path=cls.normalize_s3_file_path(file_path, study_object_id),
+            study_id=cls.get_study_pk(study_object_id),
+            **kwargs
+        )
+
+    @classmethod
+    def append_files_for_processing(cls, files: Iterable[Tuple[str, str, int]], batch_size=1000) -> int:
+        """ The bulk version of append_file_for_processing, takes an iterable of (file path, study
+            object id, participant pk) tuples, and inserts them batch_size at a time with a single
+            query per batch.  Returns the number of files added. """
+        count = 0
+        batch = []
+        for file_path, study_object_id, participant_id in files:
+            batch.append(cls(
+                s3_file_path=cls.normalize_s3_file_path(file_path, study_object_id),
+                study_id=cls.get_study_pk(study_object_id),
+                participant_id=participant_id,
+            ))
+            if len(batch) == batch_size:
+                cls.objects.bulk_create(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            cls.objects.bulk_create(batch)
+            count += len(batch)
+        return count
+
+    @classmethod
+    def get_study_pk(cls, study_object_id: str) -> int:
+        if study_object_id not in cls.study_pks:
+            cls.study_pks[study_object_id] = \
+                Study.objects.filter(object_id=study_object_id).values_list('pk', flat=True).get()
+        return cls.study_pks[study_object_id]
+
+    @staticmethod
+    def normalize_s3_file_path(file_path: str, study_object_id: str) -> str:
+        """ File paths of FilesToProcess start with the study object id. """
         if file_path[:24] == study_object_id:
-            cls.objects.create(s3_file_path=file_path, study_id=study_pk, **kwargs)
-        else:
-            cls.objects.create(s3_file_path=study_object_id + '/' + file_path, study_id=study_pk, **kwargs)
+            return file_path
+        return study_object_id + '/' + file_path
 
 
 class FileProcessLock(AbstractModel):
@@ -193,6 +285,83 @@ class FileProcessLock(AbstractModel):
         return timezone.now() - FileProcessLock.objects.last().lock_time
 
 
+class ParticipantProcessingLease(AbstractModel):
+    """
+    A lease on processing the files of one participant.  A lease has an owner (a string unique to
+    the process that acquired it) and expires unless it is renewed (heartbeat) by its owner; an
+    expired lease can be taken over by anyone, so a processing run that dies does not block its
+    participant for longer than the lease duration.
+    """
+    participant = models.OneToOneField(
+        'Participant', on_delete=models.CASCADE, related_name='processing_lease'
+    )
+    owner = models.CharField(max_length=128, db_index=True)
+    lock_time = models.DateTimeField()
+    expires = models.DateTimeField(db_index=True)
+
+    @classmethod
+    def acquire(cls, participant_id: int, duration: timedelta) -> Optional[str]:
+        """ Returns the owner string of the new lease, or None if the participant has a lease that
+            has not expired.  (The unique participant field makes creation atomic, the conditional
+            update makes takeovers atomic.) """
+        owner = "%s:%s:%s" % (gethostname(), getpid(), uuid4().hex)
+        now = timezone.now()
+        try:
+            with transaction.atomic():
+                cls.objects.create(
+                    participant_id=participant_id, owner=owner, lock_time=now, expires=now + duration
+                )
+            return owner
+        except IntegrityError:
+            pass
+
+        if cls.objects.filter(participant_id=participant_id, expires__lt=now).update(
+                owner=owner, lock_time=now, expires=now + duration, last_updated=now):
+            return owner
+        return None
+
+    @classmethod
+    def heartbeat(cls, owner: str, duration: timedelta) -> bool:
+        """ Extends the lease, returns False if the owner no longer holds it. """
+        now = timezone.now()
+        return bool(
+            cls.objects.filter(owner=owner).update(expires=now + duration, last_updated=now)
+        )
+
+    @classmethod
+    def release(cls, owner: str):
+        cls.objects.filter(owner=owner).delete()
+
+    @classmethod
+    def active(cls):
+        return cls.objects.filter(expires__gte=timezone.now())
+
+
+class ExportArchive(AbstractModel):
+    """
+    A data access api download (the zip of the chunks of a query) built ahead of time, stored
+    encrypted on s3, so that repeated downloads of data that no longer changes are served from a
+    single file instead of fetching every chunk.  An archive is only served while the state of
+    its query's ChunkRegistries is the one it was built from, see libs.export_archives.
+    """
+    study = models.ForeignKey('Study', on_delete=models.PROTECT, related_name='export_archives')
+    query_digest = models.CharField(max_length=64)
+    query = models.TextField()  # json, see libs.export_archives.serialize_query
+    construct_registry = models.BooleanField()
+    compress = models.BooleanField()
+
+    requested_on = models.DateTimeField()
+    request_count = models.IntegerField(default=0)
+
+    chunk_state = models.CharField(max_length=64, blank=True)  # empty until the archive is built
+    s3_path = models.CharField(max_length=256, blank=True)
+    file_size = models.BigIntegerField(null=True, default=None)
+    built_on = models.DateTimeField(null=True, default=None)
+
+    class Meta:
+        unique_together = ('study', 'query_digest')
+
+
 
 class InvalidUploadParameterError(Exception): pass
 
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0024_custom'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ParticipantProcessingLease',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('deleted', models.BooleanField(default=False)),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+                ('owner', models.CharField(db_index=True, max_length=128)),
+                ('lock_time', models.DateTimeField()),
+                ('expires', models.DateTimeField(db_index=True)),
+                ('participant', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='processing_lease', to='database.Participant')),
+            ],
+        ),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0025_participantprocessinglease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportArchive',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('deleted', models.BooleanField(default=False)),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+                ('query_digest', models.CharField(max_length=64)),
+                ('query', models.TextField()),
+                ('construct_registry', models.BooleanField()),
+                ('compress', models.BooleanField()),
+                ('requested_on', models.DateTimeField()),
+                ('request_count', models.IntegerField(default=0)),
+                ('chunk_state', models.CharField(blank=True, max_length=64)),
+                ('s3_path', models.CharField(blank=True, max_length=256)),
+                ('file_size', models.BigIntegerField(default=None, null=True)),
+                ('built_on', models.DateTimeField(default=None, null=True)),
+                ('study', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='export_archives', to='database.Study')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='exportarchive',
+            unique_together=set([('study', 'query_digest')]),
+        ),
+    ]
@@ -36,10 +36,12 @@ def watch_files_to_process():
         print(f"{now}: {count} files to process")
 
         if i % 8 == 0:
-            first = FileProcessLock.objects.first()
+            leases = ParticipantProcessingLease.active().order_by("lock_time")
+            first = leases.first()
             if first:
                 duration = (now_dt - first.lock_time).total_seconds() / 3600
-                print(f"{now}: processing has been running for {duration} hours.")
+                print(f"{now}: {leases.count()} participant(s) are being processed, "
+                      f"the longest running for {duration} hours.")
             else:
                 print("processing does not appear to be active. (naive check)")
         sleep(4)
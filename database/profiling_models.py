@@ -82,29 +82,19 @@ class UploadTracking(AbstractModel):
 
         from database.data_access_models import FileToProcess
 
-        # uhg need to cache participants...
-        participant_cache = {}
-
-        for i, (file_path, participant__study__object_id, participant_id) in enumerate(uploads):
-            if participant_id in participant_cache:
-                participant = participant_cache[participant_id]
-            else:
-                participant = Participant.objects.get(id=participant_id)
-                participant_cache[participant_id] = participant
-
-            if i % 10 == 0:
-                print(i, sep="... ")
-
-            if FileToProcess.objects.filter(s3_file_path__icontains=file_path).exists():
-                print(f"skipping {file_path}, appears to already be present")
-                continue
-
-            FileToProcess.append_file_for_processing(
-                # file_path, study_object_id, **kwargs
-                file_path,
-                participant__study__object_id,
-                participant=participant,
-            )
+        # {the path of the upload's FileToProcess: (file_path, study_object_id, participant_id)}
+        files = {
+            FileToProcess.normalize_s3_file_path(file_path, study_object_id): (file_path, study_object_id, participant_id)
+            for file_path, study_object_id, participant_id in uploads
+        }
+        already_present = set(FileToProcess.objects.filter(s3_file_path__in=list(files)).values_list(
+            "s3_file_path", flat=True
+        ))
+        for s3_file_path in already_present:
+            print(f"skipping {files.pop(s3_file_path)[0]}, appears to already be present")
+
+        count = FileToProcess.append_files_for_processing(files.values())
+        print(f"added {count} files to process.")
 
     @classmethod
     def get_trailing_count(cls, time_delta):
@@ -1,10 +1,11 @@
 
 from django.utils import timezone
 from django.core.exceptions import ObjectDoesNotExist
-from django.db.models.signals import post_save, pre_save
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 
 from database.study_models import DeviceSettings, Study, Survey, SurveyArchive
+from database.user_models import StudyRelation
 
 
 @receiver(post_save, sender=Study)
@@ -21,6 +22,22 @@ def populate_study_device_settings(sender, **kwargs):
         DeviceSettings.objects.create(study=my_study)
 
 
+@receiver(post_save, sender=Study)
+def invalidate_cached_study_encryption_key(sender, **kwargs):
+    """ Drops the saved Study's encryption key from this process's key cache. """
+    from libs.encryption import invalidate_study_encryption_key
+    invalidate_study_encryption_key(kwargs['instance'].object_id)
+
+
+@receiver(post_save, sender=StudyRelation)
+@receiver(post_delete, sender=StudyRelation)
+def invalidate_cached_access_keys(sender, **kwargs):
+    """ Drops the researcher's validated access keys (which include the studies they have access
+    to) from this process's cache. """
+    from libs.data_access_authentication import invalidate_validated_access_keys
+    invalidate_validated_access_keys(kwargs['instance'].researcher_id)
+
+
 @receiver(pre_save, sender=Survey)
 def create_survey_archive(sender, **kwargs):
     """
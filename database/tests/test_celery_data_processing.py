@@ -0,0 +1,48 @@
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from services import celery_data_processing
+
+
+class FakeLease(object):
+    """ A ParticipantLease that is always held, without the database or the heartbeat thread. """
+
+    def __init__(self, participant_id: int):
+        self.participant_id = participant_id
+
+    def acquire(self) -> bool:
+        return True
+
+    def check(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+class CeleryProcessFileChunksTests(SimpleTestCase):
+
+    @mock.patch.object(celery_data_processing, "close_cpu_pool")
+    @mock.patch.object(celery_data_processing, "get_cpu_pool")
+    @mock.patch.object(celery_data_processing, "ParticipantLease", FakeLease)
+    @mock.patch.object(celery_data_processing, "Participant")
+    @mock.patch.object(celery_data_processing, "do_process_user_file_chunks", autospec=True)
+    def test_celery_process_file_chunks(self, do_process_user_file_chunks, Participant,
+                                        get_cpu_pool, close_cpu_pool):
+        # (autospec: the task must call do_process_user_file_chunks with its real signature)
+        Participant.objects.get.return_value = mock.Mock(pk=1, patient_id="patient1")
+        do_process_user_file_chunks.side_effect = [(1, 10), (0, None)]
+
+        celery_data_processing.celery_process_file_chunks(1)
+
+        self.assertEqual(do_process_user_file_chunks.call_count, 2)
+        first_page, second_page = do_process_user_file_chunks.call_args_list
+        self.assertIsInstance(first_page[1]["lease"], FakeLease)
+        self.assertEqual(first_page[1]["after_id"], 0)
+        self.assertEqual(second_page[1]["after_id"], 10)
+        get_cpu_pool.assert_called_once_with()
+        close_cpu_pool.assert_called_once_with()
@@ -0,0 +1,57 @@
+import time
+from threading import Lock
+
+from django.test import SimpleTestCase
+
+from libs.concurrent_download import fetch_concurrently
+
+
+class FetchConcurrentlyTests(SimpleTestCase):
+
+    def test_ordered_out_of_order_completion(self):
+        # later items finish first, the results must still be yielded in order.
+        def fetch(i):
+            time.sleep((10 - i % 10) * 0.002)
+            return i
+
+        results = list(fetch_concurrently(fetch, range(50), lambda result: 1, 8, ordered=True))
+        self.assertEqual(results, list(range(50)))
+
+    def test_ordered_memory_limit(self):
+        # the fetches in flight and the results waiting on an earlier one are limited to
+        # memory_limit, results are 100 bytes so at most 3 may be outstanding.
+        lock = Lock()
+        outstanding = [0, 0]  # current, peak
+
+        def fetch(i):
+            with lock:
+                outstanding[0] += 1
+                outstanding[1] = max(outstanding)
+            # the first item of every group of 5 is the slowest
+            time.sleep(0.02 if i % 5 == 0 else 0.001)
+            return i, b"x" * 100
+
+        results = []
+        for i, data in fetch_concurrently(fetch, range(40), lambda result: len(result[1]), 8,
+                                          memory_limit=300, expected_size=lambda i: 100,
+                                          ordered=True):
+            results.append(i)
+            with lock:
+                outstanding[0] -= 1
+        self.assertEqual(results, list(range(40)))
+        self.assertLessEqual(outstanding[1], 3)
+
+    def test_single_fetch_larger_than_memory_limit(self):
+        results = list(fetch_concurrently(lambda i: (i, b"x" * 1000), range(5),
+                                          lambda result: len(result[1]), 4, memory_limit=10,
+                                          ordered=True))
+        self.assertEqual([i for i, _ in results], list(range(5)))
+
+    def test_exception_is_reraised(self):
+        def fetch(i):
+            if i == 3:
+                raise ValueError(i)
+            return i
+
+        with self.assertRaises(ValueError):
+            list(fetch_concurrently(fetch, range(10), lambda result: 1, 2, ordered=True))
@@ -0,0 +1,123 @@
+import random
+from datetime import datetime
+from itertools import islice
+
+from django.test import SimpleTestCase
+
+from api.data_access_api import find_chunk_row, get_manifest_files, trim_chunk_rows
+
+HEADER = b"timestamp,UTC time,value"
+
+
+def make_chunk(timestamps, trailing_newline=False) -> bytes:
+    rows = [b"%d,utc,%d" % (timestamp, i) for i, timestamp in enumerate(timestamps)]
+    return b"\n".join([HEADER] + rows) + (b"\n" if trailing_newline else b"")
+
+
+def brute_force_trim(file_data: bytes, start=None, end=None) -> bytes:
+    """ trim_chunk_rows, by parsing every row. """
+    header, _, body = file_data.partition(b"\n")
+    rows = [
+        row for row in body.split(b"\n") if row and
+        (start is None or int(row.split(b",")[0]) >= start) and
+        (end is None or int(row.split(b",")[0]) <= end)
+    ]
+    return b"\n".join([header] + rows)
+
+
+class TrimChunkRowsTests(SimpleTestCase):
+
+    def test_trim_chunk_rows_matches_brute_force(self):
+        rng = random.Random(0)
+        for _ in range(2000):
+            # sorted, with repeated timestamps
+            timestamps = sorted(rng.randint(0, 50) for _ in range(rng.randint(0, 12)))
+            file_data = make_chunk(timestamps, trailing_newline=rng.random() < 0.5)
+            start = rng.choice([None, rng.randint(-5, 55)])
+            end = rng.choice([None, rng.randint(-5, 55)])
+            self.assertEqual(trim_chunk_rows(file_data, start, end),
+                             brute_force_trim(file_data, start, end),
+                             (file_data, start, end))
+
+    def test_trim_chunk_rows_header_only(self):
+        self.assertEqual(trim_chunk_rows(HEADER, 10, 20), HEADER)
+        self.assertEqual(trim_chunk_rows(HEADER + b"\n", 10, 20), HEADER)
+
+    def test_trim_chunk_rows_trailing_newline(self):
+        file_data = make_chunk([1, 2, 3], trailing_newline=True)
+        self.assertEqual(trim_chunk_rows(file_data, 2, None), HEADER + b"\n2,utc,1\n3,utc,2")
+        self.assertEqual(trim_chunk_rows(file_data, None, 2), HEADER + b"\n1,utc,0\n2,utc,1")
+        self.assertEqual(trim_chunk_rows(file_data, 4, None), HEADER)
+
+    def test_trim_chunk_rows_invalid_timestamp(self):
+        file_data = HEADER + b"\n1,utc,0\nnot a timestamp,utc,1\n3,utc,2"
+        self.assertEqual(trim_chunk_rows(file_data, 2, None), file_data)
+
+    def test_find_chunk_row(self):
+        file_data = make_chunk([1, 2, 2, 5])
+        first_row = len(HEADER) + 1
+        self.assertEqual(find_chunk_row(file_data, first_row, 0), first_row)
+        self.assertEqual(find_chunk_row(file_data, first_row, 2), file_data.index(b"2,utc,1"))
+        self.assertEqual(find_chunk_row(file_data, first_row, 3), file_data.index(b"5,utc,3"))
+        self.assertEqual(find_chunk_row(file_data, first_row, 6), len(file_data))
+
+
+class FakeChunkQuerySet(object):
+    """ The parts of a ChunkRegistry values() queryset that get_manifest_files uses. """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def filter(self, pk__lte):
+        return FakeChunkQuerySet([chunk for chunk in self.chunks if chunk["pk"] <= pk__lte])
+
+    def order_by(self, field):
+        return FakeChunkQuerySet(sorted(self.chunks, key=lambda chunk: chunk[field]))
+
+    def iterator(self):
+        return iter(self.chunks)
+
+
+def make_manifest_chunk(pk, hour, patient_id="patient1", data_type="accelerometer"):
+    return {
+        "pk": pk, "participant__patient_id": patient_id, "data_type": data_type,
+        "chunk_path": "study/%s/%s/%s.csv" % (patient_id, data_type, pk),
+        "time_bin": datetime(2020, 1, 1, hour),
+    }
+
+
+class ManifestTests(SimpleTestCase):
+
+    def setUp(self):
+        # (out of primary key order, as a query may return them)
+        self.chunks = [make_manifest_chunk(pk, pk % 24) for pk in (7, 3, 1, 12, 5, 9, 2, 11)]
+
+    def test_manifest_order(self):
+        files = list(get_manifest_files(FakeChunkQuerySet(self.chunks), 100))
+        self.assertEqual([chunk["pk"] for chunk in files], [1, 2, 3, 5, 7, 9, 11, 12])
+
+    def test_manifest_excludes_later_chunks(self):
+        # chunks created after the download started (by the max_pk of its manifest) do not shift
+        # the offsets, even those that sort before earlier chunks in the zip.
+        before = list(get_manifest_files(FakeChunkQuerySet(self.chunks), 12))
+        self.chunks.append(make_manifest_chunk(13, 0, patient_id="patient0"))
+        self.chunks.append(make_manifest_chunk(14, 14))
+        after = list(get_manifest_files(FakeChunkQuerySet(self.chunks), 12))
+        self.assertEqual(after, before)
+
+    def test_manifest_skips_duplicate_file_names(self):
+        # the same participant, data stream and hour, so the same file name in the zip.
+        self.chunks.append(make_manifest_chunk(10, 7))
+        files = list(get_manifest_files(FakeChunkQuerySet(self.chunks), 100))
+        self.assertEqual([chunk["pk"] for chunk in files], [1, 2, 3, 5, 7, 9, 11, 12])
+
+    def test_manifest_resume(self):
+        # a download resumed at an offset, with a limit, as get_data does.
+        files = list(get_manifest_files(FakeChunkQuerySet(self.chunks), 100))
+        for limit in (1, 3, 5):
+            resumed = []
+            for offset in range(0, len(files), limit):
+                resumed.extend(islice(
+                    get_manifest_files(FakeChunkQuerySet(self.chunks), 100), offset, offset + limit
+                ))
+            self.assertEqual(resumed, files)
@@ -0,0 +1,101 @@
+import random
+from os import urandom
+from unittest import mock
+
+from Crypto.Cipher import AES
+from django.test import SimpleTestCase
+
+from libs import encryption
+from libs.encryption import decrypt_device_line, decrypt_device_lines, get_device_file_key
+from libs.security import encode_base64
+
+
+def encrypt_device_line(key: bytes, line: bytes) -> bytes:
+    """ Encrypts a line as the apps do: AES CBC with PKCS5 padding, iv:data in base64. """
+    iv = urandom(16)
+    padding = 16 - len(line) % 16
+    data = AES.new(key, mode=AES.MODE_CBC, IV=iv).encrypt(line + bytes([padding]) * padding)
+    return encode_base64(iv) + b":" + encode_base64(data)
+
+
+class DecryptDeviceLinesTests(SimpleTestCase):
+
+    def setUp(self):
+        self.key = urandom(16)
+        rng = random.Random(0)
+        self.lines = [
+            bytes(rng.randrange(32, 127) for _ in range(rng.randint(0, 100))) for _ in range(200)
+        ]
+        self.encrypted_lines = [encrypt_device_line(self.key, line) for line in self.lines]
+
+    def test_decrypt_device_lines(self):
+        decrypted_lines = decrypt_device_lines(self.key, self.encrypted_lines)
+        self.assertEqual([bytes(line) for line in decrypted_lines], self.lines)
+
+    def test_decrypt_device_lines_matches_decrypt_device_line(self):
+        for encrypted_line, decrypted_line in zip(
+                self.encrypted_lines, decrypt_device_lines(self.key, self.encrypted_lines)):
+            self.assertEqual(bytes(decrypted_line),
+                             decrypt_device_line("patient1", self.key, encrypted_line))
+
+    def test_decrypt_device_lines_malformed_lines(self):
+        # malformed lines are None, for decrypt_device_line to report, the others are decrypted.
+        iv = encode_base64(urandom(16))
+        malformed_lines = [
+            b"",
+            b"no colon",
+            iv + b":" + encode_base64(urandom(16)) + b":" + encode_base64(urandom(16)),
+            iv + b":",  # no data
+            encode_base64(urandom(8)) + b":" + encode_base64(urandom(16)),  # short iv
+            iv + b":" + encode_base64(urandom(20)),  # not a whole number of blocks
+            iv + b":!!not base64!!",
+        ]
+        lines = []
+        for i, encrypted_line in enumerate(self.encrypted_lines):
+            lines.append(encrypted_line)
+            lines.append(malformed_lines[i % len(malformed_lines)])
+
+        decrypted_lines = decrypt_device_lines(self.key, lines)
+        self.assertEqual([bytes(line) for line in decrypted_lines[::2]], self.lines)
+        self.assertEqual(decrypted_lines[1::2], [None] * len(self.lines))
+
+        # decrypt_device_file falls back to decrypt_device_line for the None lines, which raises.
+        for malformed_line in malformed_lines:
+            with self.assertRaises(Exception):
+                decrypt_device_line("patient1", self.key, malformed_line)
+
+    def test_decrypt_device_lines_invalid_key(self):
+        self.assertEqual(decrypt_device_lines(b"not a key", self.encrypted_lines),
+                         [None] * len(self.encrypted_lines))
+
+    def test_decrypt_device_lines_no_lines(self):
+        self.assertEqual(decrypt_device_lines(self.key, []), [])
+
+
+class FakePrivateKeyCipher(object):
+    def decrypt(self, encrypted_key: bytes) -> bytes:
+        return encode_base64(encrypted_key[::-1])
+
+
+@mock.patch.object(encryption, "DEVICE_KEY_CACHE_REPORT_INTERVAL", 1)
+@mock.patch.object(encryption, "make_sentry_client")
+class DeviceKeyCacheStatsTests(SimpleTestCase):
+
+    def test_device_key_cache_stats_are_reported(self, make_sentry_client):
+        encryption.invalidate_device_keys("patient1")
+        encrypted_key = urandom(32)
+        for _ in range(2):
+            self.assertEqual(get_device_file_key("patient1", encrypted_key, FakePrivateKeyCipher()),
+                             encode_base64(encrypted_key[::-1]))
+
+        capture_message = make_sentry_client.return_value.captureMessage
+        self.assertEqual(capture_message.call_count, 2)
+        stats = capture_message.call_args[1]["extra"]
+        self.assertEqual(set(stats), {"hits", "misses", "hit_rate", "size"})
+        self.assertGreaterEqual(stats["hits"], 1)
+
+    def test_failed_report_does_not_fail_the_lookup(self, make_sentry_client):
+        make_sentry_client.side_effect = Exception("no sentry")
+        encrypted_key = urandom(32)
+        self.assertEqual(get_device_file_key("patient1", encrypted_key, FakePrivateKeyCipher()),
+                         encode_base64(encrypted_key[::-1]))
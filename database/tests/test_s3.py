@@ -1,6 +1,9 @@
-from django.test import TransactionTestCase
+from unittest import mock
+
+from django.test import SimpleTestCase, TransactionTestCase
 
 from database.study_models import Study
+from libs import s3
 from libs.s3 import s3_upload, s3_retrieve
 
 
@@ -20,3 +23,46 @@ class TestRoutes(TransactionTestCase):
         s3_upload("test_file_for_tests.txt", test_data, study.object_id)
         s3_data = s3_retrieve("test_file_for_tests.txt", study.object_id)
         self.assertEqual(s3_data, test_data)
+
+
+@mock.patch.object(s3.encryption, "get_RSA_cipher", lambda key: key)
+class ClientPrivateKeyCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        s3.clear_client_private_keys()
+
+    def tearDown(self):
+        s3.clear_client_private_keys()
+
+    def test_get_client_private_key_is_cached(self):
+        with mock.patch.object(s3, "s3_retrieve", return_value=b"key1") as s3_retrieve:
+            self.assertEqual(s3.get_client_private_key("patient1", "study"), b"key1")
+            self.assertEqual(s3.get_client_private_key("patient1", "study"), b"key1")
+        self.assertEqual(s3_retrieve.call_count, 1)
+
+    def test_invalidate_client_private_key(self):
+        with mock.patch.object(s3, "s3_retrieve", side_effect=[b"key1", b"key2"]):
+            self.assertEqual(s3.get_client_private_key("patient1", "study"), b"key1")
+            s3.invalidate_client_private_key("patient1")
+            self.assertEqual(s3.get_client_private_key("patient1", "study"), b"key2")
+
+    def test_invalidated_during_fetch_is_not_cached(self):
+        # the key pair is replaced while the old key is being fetched.
+        def retrieve_old_key(*args, **kwargs):
+            s3.invalidate_client_private_key("patient1")
+            return b"old key"
+
+        with mock.patch.object(s3, "s3_retrieve", side_effect=retrieve_old_key):
+            self.assertEqual(s3.get_client_private_key("patient1", "study"), b"old key")
+        with mock.patch.object(s3, "s3_retrieve", return_value=b"new key"):
+            self.assertEqual(s3.get_client_private_key("patient1", "study"), b"new key")
+
+    def test_cleared_during_fetch_is_not_cached(self):
+        def retrieve_old_key(*args, **kwargs):
+            s3.clear_client_private_keys()
+            return b"old key"
+
+        with mock.patch.object(s3, "s3_retrieve", side_effect=retrieve_old_key):
+            s3.get_client_private_key("patient1", "study")
+        with mock.patch.object(s3, "s3_retrieve", return_value=b"new key"):
+            self.assertEqual(s3.get_client_private_key("patient1", "study"), b"new key")
@@ -111,6 +111,12 @@ class Participant(AbstractPasswordUser):
     def generate_hash_and_salt(self, password):
         return generate_user_hash_and_salt(password)
 
+    def set_password(self, password: str):
+        super().set_password(password)
+        # drops this participant's cached credentials, see libs.user_authentication.
+        from libs.user_authentication import invalidate_participant_credentials
+        invalidate_participant_credentials(self.patient_id)
+
     def debug_validate_password(self, compare_me):
         """
         Checks if the input matches the instance's password hash, but does
@@ -131,6 +137,8 @@ class Participant(AbstractPasswordUser):
     def clear_device(self):
         self.device_id = ''
         self.save()
+        from libs.user_authentication import invalidate_participant_credentials
+        invalidate_participant_credentials(self.patient_id)
 
 
     def __str__(self):
@@ -263,6 +271,9 @@ class Researcher(AbstractPasswordUser):
         self.access_key_secret = secret_hash.decode()
         self.access_key_secret_salt = secret_salt.decode()
         self.save()
+        # drops this researcher's cached access keys, see libs.data_access_authentication.
+        from libs.data_access_authentication import invalidate_validated_access_keys
+        invalidate_validated_access_keys(self.pk)
         return access_key.decode(), secret_key.decode()
 
     def get_admin_study_relations(self):
@@ -0,0 +1,170 @@
+import zlib
+from os import remove
+from tempfile import NamedTemporaryFile
+from threading import Lock
+
+from config.constants import CHUNK_BUFFER_MEMORY_BYTES, CHUNK_BUFFER_SPILL_BYTES
+
+
+# The number of bytes held in memory by all ChunkBuffers in this process.
+_memory_in_use = 0
+_memory_lock = Lock()
+
+
+def _account(number_bytes: int):
+    global _memory_in_use
+    with _memory_lock:
+        _memory_in_use += number_bytes
+
+
+def memory_pressure() -> bool:
+    return _memory_in_use > CHUNK_BUFFER_MEMORY_BYTES
+
+
+class ChunkBuffer(object):
+    """
+    Holds the contents of a chunk (a csv) between the merge and upload stages of file processing.
+
+    Contents are held in memory, uncompressed.  Writes made while the ChunkBuffers of this process
+    together hold more than CHUNK_BUFFER_MEMORY_BYTES switch the buffer to holding its contents
+    compressed, and a buffer that holds more than CHUNK_BUFFER_SPILL_BYTES moves its contents to a
+    temporary file.  Call finish() after the last write, iter_contents() returns the contents in
+    parts (getvalue() all at once), close() releases them.
+
+    ChunkBuffers can be pickled (after finish()), a spilled buffer is passed by the path of its
+    temporary file.  Pickling hands the contents over to the unpickled buffer: the pickled buffer
+    is closed, and cannot be read from afterwards (it is used to return buffers from the cpu pool,
+    see libs.file_processing).
+    """
+
+    def __init__(self):
+        self.parts = []         # the contents in memory, raw or compressed
+        self.file = None        # the temporary file the contents were spilled to
+        self.compressor = None  # a zlib compressobj, while compressed contents are being written
+        self.compressed = False
+        self.size = 0           # the size of the (uncompressed) contents
+        self.held = 0           # the number of bytes held in memory
+        self.finished = False
+
+    def write(self, data: bytes):
+        if self.finished:
+            raise ValueError("ChunkBuffer was already finished.")
+        self.size += len(data)
+
+        if not self.compressed and self.file is None and memory_pressure():
+            # compress what is already held, and everything from here on.
+            held = b"".join(self.parts)
+            self.parts = []
+            self._release()
+            self.compressor = zlib.compressobj()
+            self.compressed = True
+            self._store(self.compressor.compress(held))
+            del held
+
+        self._store(self.compressor.compress(data) if self.compressor else data)
+
+    def finish(self):
+        if self.compressor:
+            self._store(self.compressor.flush())
+            self.compressor = None
+        if self.file:
+            self.file.flush()
+        self.finished = True
+
+    def getvalue(self) -> bytes:
+        """ Returns the (uncompressed) contents. """
+        if not self.finished:
+            raise ValueError("ChunkBuffer is not finished.")
+        if self.file:
+            self.file.seek(0)
+            stored = self.file.read()
+        else:
+            stored = b"".join(self.parts)
+        return zlib.decompress(stored) if self.compressed else stored
+
+    def iter_contents(self, block_size=1024*1024):
+        """ Yields the (uncompressed) contents in parts of about block_size, the contents are never
+        held in memory all at once (unless they already are). """
+        if not self.finished:
+            raise ValueError("ChunkBuffer is not finished.")
+        if self.file:
+            self.file.seek(0)
+            stored_parts = iter(lambda: self.file.read(block_size), b"")
+        else:
+            stored_parts = iter(self.parts)
+
+        if not self.compressed:
+            yield from stored_parts
+            return
+
+        decompressor = zlib.decompressobj()
+        for stored in stored_parts:
+            while stored:
+                data = decompressor.decompress(stored, block_size)
+                stored = decompressor.unconsumed_tail
+                if data:
+                    yield data
+        data = decompressor.flush()
+        if data:
+            yield data
+
+    def close(self):
+        self.parts = []
+        self._release()
+        if self.file:
+            self.file.close()
+            remove(self.file.name)
+            self.file = None
+
+    @property
+    def spilled(self) -> bool:
+        return self.file is not None
+
+    def _store(self, stored: bytes):
+        if not stored:
+            return
+        if self.file:
+            self.file.write(stored)
+            return
+
+        self.parts.append(stored)
+        self.held += len(stored)
+        _account(len(stored))
+        if self.held > CHUNK_BUFFER_SPILL_BYTES:
+            self.file = NamedTemporaryFile(prefix="chunk_buffer_", delete=False)
+            for part in self.parts:
+                self.file.write(part)
+            self.parts = []
+            self._release()
+
+    def _release(self):
+        _account(-self.held)
+        self.held = 0
+
+    def __del__(self):
+        self.close()
+
+    def __getstate__(self):
+        # (this closes the buffer, see the class docstring)
+        if not self.finished:
+            raise ValueError("ChunkBuffer is not finished.")
+        state = {"size": self.size, "compressed": self.compressed}
+        if self.file:
+            # the file is handed over to the unpickled buffer.
+            self.file.close()
+            state["path"] = self.file.name
+            self.file = None
+        else:
+            state["contents"] = b"".join(self.parts)
+        self.close()
+        return state
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.size = state["size"]
+        self.finished = True
+        self.compressed = state["compressed"]
+        if "path" in state:
+            self.file = open(state["path"], "rb")
+        else:
+            self._store(state["contents"])
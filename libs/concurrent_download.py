@@ -0,0 +1,127 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import monotonic
+from typing import Callable, Generator, Iterable
+
+
+# In adaptive mode the number of concurrent fetches is re-evaluated every this many fetches.
+ADAPT_INTERVAL = 20
+# A change in throughput smaller than this fraction is treated as no change.
+ADAPT_TOLERANCE = 0.05
+
+
+def fetch_concurrently(function: Callable, items: Iterable, result_size: Callable,
+                       concurrency: int, max_concurrency: int = None, memory_limit: int = None,
+                       expected_size: Callable = None, ordered: bool = False) -> Generator:
+    """
+    Runs function (a network fetch) over items on concurrency threads, yields the results in
+    completion order, or in the order of the items if ordered is set.  Exceptions raised by
+    function are re-raised in the consumer.
+
+    Items are only pulled from the (lazy) input when a fetch can be started, and fetches are only
+    started while the consumer is pulling results, so a slow consumer stops the fetching.  The
+    fetches in flight (and, if ordered, the results waiting on an earlier one) are also limited to
+    memory_limit bytes: the size of an item's result is estimated as the average of result_size of
+    the results so far, or expected_size(item) if that is larger.  (expected_size is only a lower
+    bound, it may return None.)  A single fetch is always allowed, however large.  If ordered, at
+    most concurrency more results may wait.
+
+    If max_concurrency is greater than concurrency the number of concurrent fetches adapts, between
+    1 and max_concurrency: every ADAPT_INTERVAL fetches it is moved one step in whichever direction
+    last improved throughput (bytes fetched per second), and it is reduced while results are
+    buffered faster than the consumer takes them (more than half of memory_limit done and waiting).
+    """
+    max_concurrency = max(max_concurrency or concurrency, concurrency)
+    adaptive = max_concurrency > concurrency
+    items = iter(items)
+    exhausted = False
+
+    target = concurrency
+    in_flight = {}  # future: (index of its item, estimated size of its result)
+    held = {}  # (ordered) index of item: (result, size), for results waiting on an earlier one
+    held_bytes = 0
+    in_flight_bytes = 0
+    submitted_count = 0
+    next_index = 0
+    fetched_count = 0
+    fetched_bytes = 0
+
+    # adaptive mode state
+    direction = 1
+    window_start = monotonic()
+    window_bytes = 0
+    window_count = 0
+    window_buffered_peak = 0
+    previous_throughput = None
+
+    pool = ThreadPoolExecutor(max_workers=max_concurrency)
+    try:
+        while True:
+            while not exhausted and len(in_flight) < target and len(held) <= target:
+                # a single fetch is always allowed, held results may be waiting on it.
+                if memory_limit and in_flight and in_flight_bytes + held_bytes >= memory_limit:
+                    break
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                estimate = fetched_bytes // fetched_count if fetched_count else 0
+                expected = expected_size(item) if expected_size else None
+                if expected is not None:
+                    estimate = max(estimate, expected)
+                in_flight[pool.submit(function, item)] = submitted_count, estimate
+                submitted_count += 1
+                in_flight_bytes += estimate
+                del item
+
+            if not in_flight:
+                return
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            results = []
+            for future in done:
+                index, estimate = in_flight.pop(future)
+                in_flight_bytes -= estimate
+                result = future.result()
+                results.append((index, result, result_size(result)))
+                del result
+
+            buffered = sum(size for _, _, size in results)
+            fetched_count += len(results)
+            fetched_bytes += buffered
+            window_count += len(results)
+            window_bytes += buffered
+            window_buffered_peak = max(window_buffered_peak, buffered)
+            del done
+
+            if adaptive and window_count >= ADAPT_INTERVAL:
+                throughput = window_bytes / max(monotonic() - window_start, 1e-6)
+                if memory_limit and window_buffered_peak > memory_limit / 2:
+                    # the consumer is the bottleneck, more fetches would only buffer more data.
+                    direction = -1
+                elif previous_throughput is not None and throughput < previous_throughput * (1 - ADAPT_TOLERANCE):
+                    direction = -direction
+                target = min(max(target + direction, 1), max_concurrency)
+                previous_throughput = throughput
+                window_start = monotonic()
+                window_bytes = window_count = window_buffered_peak = 0
+
+            if not ordered:
+                while results:
+                    yield results.pop()[1]
+                continue
+
+            for index, result, size in results:
+                held[index] = result, size
+                held_bytes += size
+            del results
+            while next_index in held:
+                result, size = held.pop(next_index)
+                held_bytes -= size
+                next_index += 1
+                yield result
+                del result
+    finally:
+        for future in in_flight:
+            future.cancel()
+        pool.shutdown(wait=False)
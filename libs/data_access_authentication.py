@@ -1,7 +1,12 @@
 import functools
+import hashlib
+from threading import Lock
+from time import monotonic
+from typing import Optional
 
 from flask import abort, request
 
+from config.constants import ACCESS_KEY_CACHE_SECONDS, ACCESS_KEY_CACHE_SIZE
 from database.common_models import is_object_id
 from database.study_models import Study
 from database.user_models import Researcher, StudyRelation
@@ -135,3 +140,54 @@ def get_and_confirm_study_exists(study_object_id=None, study_pk=None):
 
     else:
         return abort(400)
+
+
+####################################################################################################
+################################### Access Key Cache ###############################################
+####################################################################################################
+
+# Validating an access key hashes the secret key with PBKDF2, and data access api clients (e.g. the
+# batch pipeline) make many requests with the same credentials, so validated credentials are cached
+# per process, with the researcher's access:
+# {(access key, sha256 of the secret key): (researcher pk, batch user, study pks, expiry)}
+# Researcher.reset_access_credentials drops the researcher's entries from the cache of the process it
+# runs in, as do changes to their StudyRelations (see database.signals); the expiry bounds how long
+# other processes hold an entry.
+_validated_access_keys = {}
+_validated_access_keys_lock = Lock()
+
+
+def get_validated_access_key(access_key: str, secret_key: str) -> Optional[tuple]:
+    """ Returns (researcher pk, batch user, frozenset of the pks of the researcher's studies) if the
+    credentials are valid, None if they are not.  Runs no queries if the credentials are cached.
+    "batch user" is the username test for the batch user used by the data access api. """
+    cache_key = access_key, hashlib.sha256(secret_key.encode()).digest()
+    now = monotonic()
+    with _validated_access_keys_lock:
+        cached = _validated_access_keys.get(cache_key, None)
+    if cached is not None and cached[-1] > now:
+        return cached[:-1]
+
+    researcher = Researcher.objects.filter(access_key_id=access_key).first()
+    if researcher is None or not researcher.validate_access_credentials(secret_key):
+        return None
+
+    validated = (
+        researcher.pk,
+        researcher.username.startswith("BATCH USER"),
+        frozenset(StudyRelation.objects.filter(researcher=researcher).values_list("study_id", flat=True)),
+    )
+    with _validated_access_keys_lock:
+        if len(_validated_access_keys) >= ACCESS_KEY_CACHE_SIZE:
+            for key in [key for key, value in _validated_access_keys.items() if value[-1] <= now]:
+                del _validated_access_keys[key]
+            if len(_validated_access_keys) >= ACCESS_KEY_CACHE_SIZE:
+                _validated_access_keys.clear()
+        _validated_access_keys[cache_key] = validated + (now + ACCESS_KEY_CACHE_SECONDS,)
+    return validated
+
+
+def invalidate_validated_access_keys(researcher_pk: int):
+    with _validated_access_keys_lock:
+        for key in [key for key, value in _validated_access_keys.items() if value[0] == researcher_pk]:
+            del _validated_access_keys[key]
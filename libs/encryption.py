@@ -1,17 +1,25 @@
+import hashlib
 import json
 import traceback
+from collections import OrderedDict
 from os import urandom
+from random import randrange
+from threading import Lock
+from time import monotonic
+from typing import List, Optional
 
 from Crypto.Cipher import AES
 from Crypto.PublicKey import RSA
 from flask import request
 
-from config.constants import ASYMMETRIC_KEY_LENGTH
+from config.constants import (ASYMMETRIC_KEY_LENGTH, DEVICE_KEY_CACHE_SIZE,
+    LINE_ENCRYPTION_ERRORS_PER_FILE, STUDY_KEY_CACHE_SECONDS)
 from config.settings import IS_STAGING
 from database.profiling_models import (DecryptionKeyError, EncryptionErrorMetadata,
     LineEncryptionError)
 from database.study_models import Study
 from libs.logging import log_error
+from libs.sentry import make_sentry_client
 from .security import decode_base64, encode_base64, PaddingException
 
 
@@ -71,21 +79,159 @@ def encrypt_for_server(input_string, study_object_id) -> bytes:
     Encrypts config using the ENCRYPTION_KEY, prepends the generated initialization vector.
     Use this function on an entire file (as a string).
     """
-    encryption_key = Study.objects.get(object_id=study_object_id).encryption_key.encode()  # bytes
+    encryption_key = get_study_encryption_key(study_object_id)  # bytes
     iv = urandom(16)  # bytes
     return iv + AES.new(encryption_key, AES.MODE_CFB, segment_size=8, IV=iv).encrypt(input_string)
 
 
-def decrypt_server(data: bytes, study_object_id: str) -> bytes:
-    """ Decrypts config encrypted by the encrypt_for_server function."""
-    encryption_key = Study.objects.filter(
-        object_id=study_object_id
-    ).values_list('encryption_key', flat=True).get().encode()
+def decrypt_server(data: bytes, study_object_id: str, encryption_key: bytes = None) -> bytes:
+    """ Decrypts config encrypted by the encrypt_for_server function.  The study's encryption_key
+    can be provided by callers that already have it. """
+    if encryption_key is None:
+        encryption_key = get_study_encryption_key(study_object_id)
     iv = data[:16]
     data = data[16:]
     return AES.new(encryption_key, AES.MODE_CFB, segment_size=8, IV=iv).decrypt(data)
 
 
+def server_encryptor(study_object_id: str):
+    """ For files too large to encrypt at once: returns the initialization vector and a cipher, the
+    iv followed by the output of any number of cipher.encrypt calls is the encrypt_for_server
+    output of their (concatenated) input. """
+    iv = urandom(16)
+    return iv, AES.new(get_study_encryption_key(study_object_id), AES.MODE_CFB, segment_size=8, IV=iv)
+
+
+def server_decryptor(iv: bytes, study_object_id: str, encryption_key: bytes = None):
+    """ The counterpart of server_encryptor, decrypts a file after its iv in any number of parts. """
+    if encryption_key is None:
+        encryption_key = get_study_encryption_key(study_object_id)
+    return AES.new(encryption_key, AES.MODE_CFB, segment_size=8, IV=iv)
+
+
+############################ Study Key Cache ###################################
+
+# Every S3 upload and download encrypts or decrypts with a study's key, so the keys are cached
+# per process: {study object id: (key, expiry)}.  Study keys do not change after creation, the
+# expiry is only a safety net; saving a Study invalidates its entry (see database.signals).
+_study_encryption_keys = {}
+_study_encryption_keys_lock = Lock()
+
+
+def get_study_encryption_key(study_object_id) -> bytes:
+    """ Returns the study's encryption key (bytes), only queries the database on a cache miss.
+    Safe to call from ThreadPool threads. """
+    if isinstance(study_object_id, bytes):
+        study_object_id = study_object_id.decode()
+
+    now = monotonic()
+    with _study_encryption_keys_lock:
+        cached = _study_encryption_keys.get(study_object_id, None)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+
+    encryption_key = Study.objects.filter(
+        object_id=study_object_id
+    ).values_list('encryption_key', flat=True).get().encode()
+
+    with _study_encryption_keys_lock:
+        _study_encryption_keys[study_object_id] = (encryption_key, now + STUDY_KEY_CACHE_SECONDS)
+    return encryption_key
+
+
+def invalidate_study_encryption_key(study_object_id: str):
+    with _study_encryption_keys_lock:
+        _study_encryption_keys.pop(study_object_id, None)
+
+
+def clear_study_encryption_keys():
+    with _study_encryption_keys_lock:
+        _study_encryption_keys.clear()
+
+
+def preload_study_encryption_keys():
+    """ Populates the cache with the keys of all studies in a single query. """
+    expiry = monotonic() + STUDY_KEY_CACHE_SECONDS
+    keys = {
+        object_id: (encryption_key.encode(), expiry)
+        for object_id, encryption_key in Study.objects.values_list('object_id', 'encryption_key')
+    }
+    with _study_encryption_keys_lock:
+        _study_encryption_keys.update(keys)
+
+
+############################ Device Key Cache ##################################
+
+# Every device file starts with its AES key, encrypted with the participant's public key, and the
+# RSA decryption of that line is the most expensive part of an upload.  Devices reuse a key for
+# many files, so the decrypted (base64) keys are cached per process, least recently used first
+# out: {(patient id, sha256 of the encrypted key): base64 key}.  Only keys that decrypted are cached.
+_device_keys = OrderedDict()
+_device_keys_lock = Lock()
+_device_key_cache_hits = 0
+_device_key_cache_misses = 0
+# the hit rate is reported to sentry every this many lookups, see report_device_key_cache_stats.
+DEVICE_KEY_CACHE_REPORT_INTERVAL = 1000
+
+
+def get_device_file_key(patient_id: str, encrypted_key: bytes, private_key_cipher) -> bytes:
+    """ Returns the base64 AES key of a device file, only decrypting the (decoded) first line of
+    the file with the private key on a cache miss. """
+    global _device_key_cache_hits, _device_key_cache_misses
+    cache_key = patient_id, hashlib.sha256(encrypted_key).digest()
+
+    with _device_keys_lock:
+        base64_key = _device_keys.get(cache_key, None)
+        if base64_key is not None:
+            _device_keys.move_to_end(cache_key)
+            _device_key_cache_hits += 1
+        else:
+            _device_key_cache_misses += 1
+        lookups = _device_key_cache_hits + _device_key_cache_misses
+    if lookups % DEVICE_KEY_CACHE_REPORT_INTERVAL == 0:
+        report_device_key_cache_stats()
+    if base64_key is not None:
+        return base64_key
+
+    base64_key = private_key_cipher.decrypt(encrypted_key)
+
+    with _device_keys_lock:
+        _device_keys[cache_key] = base64_key
+        while len(_device_keys) > DEVICE_KEY_CACHE_SIZE:
+            _device_keys.popitem(last=False)
+    return base64_key
+
+
+def device_key_cache_stats() -> dict:
+    """ The hit count, miss count and hit rate of this process's device key cache. """
+    with _device_keys_lock:
+        hits, misses, size = _device_key_cache_hits, _device_key_cache_misses, len(_device_keys)
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+        "size": size,
+    }
+
+
+def report_device_key_cache_stats():
+    """ Sends device_key_cache_stats to sentry as an info message (the stats are its extra data).
+    Failing to report never fails the upload. """
+    try:
+        make_sentry_client('eb', {"device_key_cache": "stats"}).captureMessage(
+            "device key cache stats", level="info", extra=device_key_cache_stats()
+        )
+    except Exception as e:
+        log_error(e, "could not report the device key cache stats")
+
+
+def invalidate_device_keys(patient_id: str):
+    """ Drops the participant's cached device keys, call when their key pair is replaced. """
+    with _device_keys_lock:
+        for cache_key in [cache_key for cache_key in _device_keys if cache_key[0] == patient_id]:
+            del _device_keys[cache_key]
+
+
 ########################### User/Device Decryption #############################
 
 
@@ -94,16 +240,30 @@ def decrypt_device_file(patient_id, original_data: bytes, private_key_cipher, us
     This function is a special handler for iOS file uploads. """
 
     def create_line_error_db_entry(error_type):
-        # declaring this inside decrypt device file to access its function-global variables
-        if IS_STAGING:
-            LineEncryptionError.objects.create(
-                type=error_type,
-                base64_decryption_key=private_key_cipher.decrypt(decoded_key),
-                line=encode_base64(line),
-                prev_line=encode_base64(file_data[i - 1] if i > 0 else ''),
-                next_line=encode_base64(file_data[i + 1] if i < len(file_data) - 1 else ''),
-                participant=user,
-            )
+        # declaring this inside decrypt device file to access its function-global variables.
+        # The errors are saved together by save_line_error_db_entries, a file with more errors than
+        # LINE_ENCRYPTION_ERRORS_PER_FILE gets a uniform random sample of them (reservoir sampling).
+        if not IS_STAGING:
+            return
+        if len(line_errors) < LINE_ENCRYPTION_ERRORS_PER_FILE:
+            slot = len(line_errors)
+            line_errors.append(None)
+        else:
+            slot = randrange(error_count)
+            if slot >= LINE_ENCRYPTION_ERRORS_PER_FILE:
+                return
+        line_errors[slot] = LineEncryptionError(
+            type=error_type,
+            base64_decryption_key=base64_key,
+            line=encode_base64(line),
+            prev_line=encode_base64(file_data[i - 1] if i > 0 else ''),
+            next_line=encode_base64(file_data[i + 1] if i < len(file_data) - 1 else ''),
+            participant=user,
+        )
+
+    def save_line_error_db_entries():
+        if line_errors:
+            LineEncryptionError.objects.bulk_create(line_errors)
 
     def create_decryption_key_error(an_traceback):
         DecryptionKeyError.objects.create(
@@ -117,6 +277,7 @@ def decrypt_device_file(patient_id, original_data: bytes, private_key_cipher, us
     error_types = []
     error_count = 0
     good_lines = []
+    line_errors = []
     file_data = [line for line in original_data.split(b'\n') if line != b""]
     
     if not file_data:
@@ -134,12 +295,15 @@ def decrypt_device_file(patient_id, original_data: bytes, private_key_cipher, us
         raise DecryptionKeyInvalidError("invalid decryption key. %s" % decode_error)
 
     try:
-        base64_key = private_key_cipher.decrypt(decoded_key)
+        base64_key = get_device_file_key(patient_id, decoded_key, private_key_cipher)
         decrypted_key = decode_base64(base64_key)
     except (TypeError, IndexError, PaddingException) as decr_error:
         create_decryption_key_error(traceback.format_exc())
         raise DecryptionKeyInvalidError("invalid decryption key. %s" % decr_error)
 
+    # the lines are decrypted together, lines that could not be are decrypted (or fail) below.
+    decrypted_lines = decrypt_device_lines(decrypted_key, file_data[1:])
+
     for i, line in enumerate(file_data):
         # we need to skip the first line (the decryption key), but need real index values in i
         if i == 0:
@@ -155,7 +319,10 @@ def decrypt_device_file(patient_id, original_data: bytes, private_key_cipher, us
             continue
             
         try:
-            good_lines.append(decrypt_device_line(patient_id, decrypted_key, line))
+            if decrypted_lines[i - 1] is not None:
+                good_lines.append(decrypted_lines[i - 1])
+            else:
+                good_lines.append(decrypt_device_line(patient_id, decrypted_key, line))
         except Exception as error_orig:
             error_string = str(error_orig)
             error_count += 1
@@ -235,10 +402,13 @@ def decrypt_device_file(patient_id, original_data: bytes, private_key_cipher, us
                 #  some unanticipated error in the file upload
             else:
                 # If none of the above errors happened, raise the error raw
+                save_line_error_db_entries()
                 raise
+            save_line_error_db_entries()
             raise HandledError(error_message)
             # if any of them did happen, raise a HandledError to cease execution.
     
+    save_line_error_db_entries()
     if error_count:
         EncryptionErrorMetadata.objects.create(
             file_name=request.values['file_name'],
@@ -254,6 +424,55 @@ def decrypt_device_file(patient_id, original_data: bytes, private_key_cipher, us
     return b"\n".join(good_lines)
 
 
+def decrypt_device_lines(key, lines: List[bytes]) -> List[Optional[memoryview]]:
+    """ Decrypts many lines (as decrypt_device_line does) with a single AES call, into a single
+    buffer.  Returns a list of the decrypted lines, as memoryviews of that buffer.  Lines that are
+    not well formed (they would raise an error in decrypt_device_line), or all of them if the key
+    is, are None in the list; pass those to decrypt_device_line for their error. """
+    decrypted_lines = [None] * len(lines)
+    try:
+        decipherer = AES.new(key, mode=AES.MODE_ECB)
+    except Exception:
+        return decrypted_lines
+
+    indexes, ivs, datas = [], [], []
+    for i, line in enumerate(lines):
+        try:
+            iv, data = line.split(b":")
+            iv = decode_base64(iv)
+            data = decode_base64(data)
+        except Exception:
+            continue
+        if len(iv) != 16 or not data or len(data) % 16:
+            continue
+        indexes.append(i)
+        ivs.append(iv)
+        datas.append(data)
+
+    if not indexes:
+        return decrypted_lines
+
+    # CBC decryption of a block is its ECB decryption xor the previous block of ciphertext, the
+    # previous block of the first block of a line is that line's iv.  The xor of the whole file
+    # is done as one (big) integer operation.
+    ciphertext = b"".join(datas)
+    previous_blocks = b"".join(iv + data[:-16] for iv, data in zip(ivs, datas))
+    decrypted = (
+        int.from_bytes(decipherer.decrypt(ciphertext), "big") ^ int.from_bytes(previous_blocks, "big")
+    ).to_bytes(len(ciphertext), "big")
+    del ciphertext, previous_blocks
+
+    # PKCS5 Padding, as in decrypt_device_line.
+    buffer = memoryview(decrypted)
+    start = 0
+    for i, data in zip(indexes, datas):
+        end = start + len(data)
+        decrypted_lines[i] = buffer[start: max(start, end - decrypted[end - 1])]
+        start = end
+
+    return decrypted_lines
+
+
 def decrypt_device_line(patient_id, key, data: bytes) -> bytes:
     """ Config is expected to be 3 colon separated values.
         value 1 is the symmetric key, encrypted with the patient's public key.
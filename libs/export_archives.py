@@ -0,0 +1,171 @@
+import hashlib
+import json
+from datetime import datetime, timedelta
+from tempfile import NamedTemporaryFile
+from typing import Generator, Optional
+
+from django.db.models import Case, Count, F, IntegerField, Max, Sum, Value, When
+from django.utils import timezone
+
+from config.constants import (API_TIME_FORMAT, EXPORT_ARCHIVE_MIN_REQUESTS,
+    EXPORT_ARCHIVE_QUIET_HOURS, EXPORT_ARCHIVE_REQUEST_DAYS, EXPORT_ARCHIVES_FOLDER)
+from database.data_access_models import ChunkRegistry, ExportArchive
+from database.study_models import Study
+from libs import encryption
+from libs.s3 import s3_delete_export_archive, s3_retrieve_stream, s3_upload_encrypted_file
+from libs.sentry import make_error_sentry
+
+# Export archives are data access api downloads built ahead of time.  Every download that an archive
+# could serve (no registry, sync token or manifest) is recorded as a request for its archive, the
+# build_export_archives cron task then builds the archives that are requested repeatedly and whose
+# data has stopped changing (e.g. the study has finished collecting data), and later downloads stream
+# the archive from s3.
+#
+# An archive is keyed by the state of its query's ChunkRegistries (see get_chunk_state), which is
+# checked on every download, so a chunk that is created, updated (its last_updated changes) or deleted
+# invalidates the archive immediately; the download is then built from the chunks, as usual, until
+# the cron task rebuilds the archive.
+#
+# Archives (and the records of requests for them) that have not been requested for
+# EXPORT_ARCHIVE_REQUEST_DAYS are deleted by the cron task.
+
+
+def serialize_query(query: dict) -> str:
+    """ The query of a download (see api.data_access_api.get_data) as json. """
+    return json.dumps({
+        key: value.strftime(API_TIME_FORMAT) if isinstance(value, datetime) else value
+        for key, value in query.items()
+    }, sort_keys=True)
+
+
+def deserialize_query(query_json: str) -> dict:
+    query = json.loads(query_json)
+    for key in ("start", "end"):
+        if key in query:
+            query[key] = datetime.strptime(query[key], API_TIME_FORMAT)
+    return query
+
+
+def get_export_digest(query: dict, construct_registry: bool, compress: bool) -> str:
+    """ Identifies a download, including the parameters that change the contents of its zip. """
+    return hashlib.sha256(
+        ("%s %s %s" % (serialize_query(query), construct_registry, compress)).encode()
+    ).hexdigest()
+
+
+def get_chunk_state(study_pk: int, query: dict) -> (str, Optional[datetime]):
+    """ Returns a hash of the state of the ChunkRegistries of a query, which changes when any of
+    them is created, updated or deleted, and the time of their most recent update.  (One aggregate
+    query, using the same indexes as the download.) """
+    state = ChunkRegistry.get_chunks_time_range(study_pk, **query).aggregate(
+        count=Count("pk"), pk_sum=Sum("pk"), pk_max=Max("pk"), last_updated=Max("last_updated")
+    )
+    state_hash = hashlib.sha256(json.dumps(state, sort_keys=True, default=str).encode()).hexdigest()
+    return state_hash, state["last_updated"]
+
+
+def get_export_archive(study: Study, query: dict, construct_registry: bool,
+                       compress: bool) -> Optional[ExportArchive]:
+    """ Records a request for the archive of a download, returns the archive if it is up to date
+    (see retrieve_export_archive), otherwise None.  Requests are counted from the first request
+    after a gap of EXPORT_ARCHIVE_REQUEST_DAYS. """
+    now = timezone.now()
+    archive, _ = ExportArchive.objects.get_or_create(
+        study=study,
+        query_digest=get_export_digest(query, construct_registry, compress),
+        defaults={"query": serialize_query(query), "construct_registry": construct_registry,
+                  "compress": compress, "requested_on": now},
+    )
+    # (the database evaluates the Case with the previous requested_on)
+    ExportArchive.objects.filter(pk=archive.pk).update(
+        request_count=Case(
+            When(requested_on__gte=now - timedelta(days=EXPORT_ARCHIVE_REQUEST_DAYS),
+                 then=F("request_count") + 1),
+            default=Value(1),
+            output_field=IntegerField(),
+        ),
+        requested_on=now,
+    )
+    if archive.s3_path and archive.chunk_state == get_chunk_state(study.pk, query)[0]:
+        return archive
+    return None
+
+
+def retrieve_export_archive(archive: ExportArchive, study: Study) -> Generator:
+    """ The contents of the archive (a zip), streamed from s3. """
+    return s3_retrieve_stream(archive.s3_path, study.object_id, raw_path=True,
+                              encryption_key=study.encryption_key.encode())
+
+
+def build_export_archive(archive: ExportArchive, chunk_state: str) -> bool:
+    """ Builds the archive from the chunks in chunk_state, returns False if the chunks changed
+    while the archive was being built (it is then not saved). """
+    # (the data access api imports this module)
+    from api.data_access_api import handle_database_query, zip_generator
+
+    study = archive.study
+    query = deserialize_query(archive.query)
+    s3_path = "%s/%s/%s.zip" % (study.object_id, EXPORT_ARCHIVES_FOLDER, archive.query_digest)
+
+    # the zip is encrypted as it is written, the temporary file is the file as stored on s3.
+    iv, encryptor = encryption.server_encryptor(study.object_id)
+    file_size = 0
+    with NamedTemporaryFile(prefix="export_archive_") as temp_file:
+        temp_file.write(iv)
+        for data in zip_generator(handle_database_query(study.pk, query), study,
+                                  construct_registry=archive.construct_registry,
+                                  compress=archive.compress):
+            file_size += len(data)
+            temp_file.write(encryptor.encrypt(data))
+            del data
+        temp_file.flush()
+
+        if get_chunk_state(study.pk, query)[0] != chunk_state:
+            return False
+        if archive.s3_path:
+            # in a versioned bucket the superseded archives would be kept.  (The current one may
+            # still be being downloaded, it is deleted by the next rebuild.)
+            s3_delete_export_archive(s3_path, old_versions_only=True)
+        s3_upload_encrypted_file(s3_path, temp_file.name)
+
+    ExportArchive.objects.filter(pk=archive.pk).update(
+        chunk_state=chunk_state, s3_path=s3_path, file_size=file_size, built_on=timezone.now()
+    )
+    return True
+
+
+def build_export_archives():
+    """ Builds the export archives that are requested and out of date, once their data has stopped
+    changing, and deletes the archives that are no longer requested. """
+    now = timezone.now()
+    delete_unrequested_export_archives(now - timedelta(days=EXPORT_ARCHIVE_REQUEST_DAYS))
+
+    archives = ExportArchive.objects.filter(
+        requested_on__gte=now - timedelta(days=EXPORT_ARCHIVE_REQUEST_DAYS),
+        request_count__gte=EXPORT_ARCHIVE_MIN_REQUESTS,
+        study__deleted=False,
+    ).order_by("pk")
+
+    for archive in archives:
+        with make_error_sentry('data', tags={"export_archive": archive.pk}):
+            chunk_state, last_updated = get_chunk_state(
+                archive.study_id, deserialize_query(archive.query)
+            )
+            if archive.s3_path and chunk_state == archive.chunk_state:
+                continue
+            if last_updated is None or last_updated > now - timedelta(hours=EXPORT_ARCHIVE_QUIET_HOURS):
+                continue
+            print("building export archive %s of study %s" % (archive.pk, archive.study_id))
+            if not build_export_archive(archive, chunk_state):
+                print("the data of export archive %s changed while it was built" % archive.pk)
+
+
+def delete_unrequested_export_archives(cutoff: datetime):
+    """ Deletes the archives, and records of requests, that were last requested before cutoff. """
+    for archive in ExportArchive.objects.filter(requested_on__lt=cutoff).order_by("pk"):
+        with make_error_sentry('data', tags={"export_archive": archive.pk}):
+            # (unless it was requested in the meantime)
+            if not ExportArchive.objects.filter(pk=archive.pk, requested_on__lt=cutoff).delete()[0]:
+                continue
+            if archive.s3_path:
+                s3_delete_export_archive(archive.s3_path)
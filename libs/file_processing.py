@@ -1,31 +1,52 @@
-import codecs
 import gc
+import hashlib
+import heapq
 import sys
 import traceback
 from collections import defaultdict, deque
-from datetime import datetime
-from multiprocessing.pool import ThreadPool
-from pprint import pprint
-from typing import DefaultDict, Generator, List, Tuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import partial
+from threading import Event, Thread
+from time import monotonic
+from typing import DefaultDict, Generator, Iterable, List, Optional, Tuple
 
 from cronutils.error_handler import ErrorHandler
+from django.db import connections, transaction
 
 # noinspection PyUnresolvedReferences
 from config import load_django
 from config.constants import (ACCELEROMETER, ANDROID_LOG_FILE, API_TIME_FORMAT, CALL_LOG,
-    CHUNK_TIMESLICE_QUANTUM, CHUNKABLE_FILES, CHUNKS_FOLDER, CONCURRENT_NETWORK_OPS,
-    DATA_PROCESSING_NO_ERROR_STRING, FILE_PROCESS_PAGE_SIZE, IDENTIFIERS, IOS_LOG_FILE,
+    CHUNK_TIMESLICE_QUANTUM, CHUNKABLE_FILES, CHUNKS_FOLDER, DATA_PROCESSING_NO_ERROR_STRING,
+    FILE_PROCESS_CPU_PROCESSES, FILE_PROCESS_DECRYPT_CONCURRENCY, FILE_PROCESS_DOWNLOAD_CONCURRENCY,
+    FILE_PROCESS_LEASE_SECONDS, FILE_PROCESS_MERGE_CONCURRENCY, FILE_PROCESS_PAGE_SIZE, FILE_PROCESS_PARSE_CONCURRENCY,
+    FILE_PROCESS_QUEUE_SIZE, FILE_PROCESS_UPLOAD_CONCURRENCY, IDENTIFIERS, IOS_LOG_FILE,
     SURVEY_DATA_FILES, SURVEY_TIMINGS, UPLOAD_FILE_TYPE_MAPPING, WIFI)
-from database.data_access_models import ChunkRegistry, FileProcessLock, FileToProcess
+from database.data_access_models import (ChunkRegistry, FileProcessLock, FileToProcess,
+    ParticipantProcessingLease)
 from database.study_models import Survey
 from database.user_models import Participant
-from libs.s3 import s3_retrieve, s3_upload
+from libs.chunk_buffer import ChunkBuffer
+from libs.encryption import decrypt_server
+from libs.s3 import s3_retrieve, s3_retrieve_encrypted, s3_upload_stream
+from libs.security import encode_chunk_hash
+from libs.staged_pipeline import pipeline_stage
 
 
 class OldBotoImportThatNeedsFixingError(Exception): pass
 class EverythingWentFine(Exception): pass
 class ProcessingOverlapError(Exception): pass
 
+# The number of csv lines written to a ChunkBuffer at a time.
+CSV_WRITE_BATCH_SIZE = 10000
+
+# b".000" through b".999", the millisecond portion of human readable timestamps.
+MILLISECOND_SUFFIXES = [b".%03d" % millisecond for millisecond in range(1000)]
+
+# When FILE_PROCESS_CPU_PROCESSES is set csv parsing and merging run on this process pool, it is
+# created by get_cpu_pool and shut down by close_cpu_pool.
+cpu_pool = None
+
 
 """########################## Hourly Update Tasks ###########################"""
 
@@ -37,50 +58,132 @@ def process_file_chunks():
     errors appropriately.
     This is primarily called manually during testing and debugging.
     """
-    # Initialize the process and ensure there is no other process running at the same time
+    # Initialize the process and ensure that no data is being reindexed at the same time
+    # (see libs.file_processing_utils), processing itself is guarded per participant by leases.
     error_handler = ErrorHandler()
     if FileProcessLock.islocked():
         raise ProcessingOverlapError("Data processing overlapped with a previous data indexing run.")
-    FileProcessLock.lock()
 
-    try:
-        number_bad_files = 0
+    number_bad_files = 0
 
-        # Get the list of participants with open files to process
-        participants = Participant.objects.filter(files_to_process__isnull=False).distinct()
-        print("processing files for the following users: %s" % ",".join(participants.values_list('patient_id', flat=True)))
+    # Get the list of participants with open files to process
+    participants = Participant.objects.filter(files_to_process__isnull=False).distinct()
+    print("processing files for the following users: %s" % ",".join(participants.values_list('patient_id', flat=True)))
 
+    # The process pool has to be created before the threads of the leases are.
+    get_cpu_pool()
+    try:
         for participant in participants:
-            while True:
-                previous_number_bad_files = number_bad_files
-                starting_length = participant.files_to_process.exclude(deleted=True).count()
-
-                print("%s processing %s, %s files remaining" % (datetime.now(), participant.patient_id, starting_length))
-
-                # Process the desired number of files and calculate the number of unprocessed files
-                number_bad_files += do_process_user_file_chunks(
-                        count=FILE_PROCESS_PAGE_SIZE,
-                        error_handler=error_handler,
-                        skip_count=number_bad_files,
-                        participant=participant,
-                )
-
-                # If no files were processed, quit processing
-                if (participant.files_to_process.exclude(deleted=True).count() == starting_length
-                        and previous_number_bad_files == number_bad_files):
-                    # Cases:
-                    #   every file broke, might as well fail here, and would cause infinite loop otherwise.
-                    #   no new files.
-                    break
+            lease = ParticipantLease(participant.pk)
+            if not lease.acquire():
+                print("%s is being processed elsewhere, skipping." % participant.patient_id)
+                continue
+
+            with lease:
+                last_id = 0
+                while True:
+                    lease.check()
+                    print("%s processing %s" % (datetime.now(), participant.patient_id))
+
+                    # Process the desired number of files, files uploaded in the meantime have higher
+                    # ids and are picked up by later pages.
+                    page_bad_files, last_id = do_process_user_file_chunks(
+                            count=FILE_PROCESS_PAGE_SIZE,
+                            error_handler=error_handler,
+                            after_id=last_id,
+                            participant=participant,
+                            lease=lease,
+                    )
+                    number_bad_files += page_bad_files
+
+                    # There are no files left (that have not already failed), quit processing
+                    if last_id is None:
+                        break
     finally:
-        FileProcessLock.unlock()
+        close_cpu_pool()
 
     error_handler.raise_errors()
     raise EverythingWentFine(DATA_PROCESSING_NO_ERROR_STRING)
 
 
-def do_process_user_file_chunks(count: int, error_handler: ErrorHandler, skip_count: int,
-                                participant: Participant):
+class ParticipantLease(object):
+    """
+    Holds the ParticipantProcessingLease of a participant; use acquire(), and if that succeeds
+    process the participant inside a with statement on the ParticipantLease.
+    Inside the with statement the lease is renewed from a background thread, and released at the
+    end.  The lease can still be lost, if renewing it failed for longer than the lease lasts.
+    Call check() before an upload, it raises a ProcessingOverlapError if the lease was lost or may
+    have expired, and make database writes inside holding(), which only commits them if the lease
+    is still held.
+    """
+
+    def __init__(self, participant_id: int):
+        self.participant_id = participant_id
+        self.duration = timedelta(seconds=FILE_PROCESS_LEASE_SECONDS)
+        self.owner = None
+        self.lost = False
+        self.renewed = None  # (monotonic) when the lease was last acquired or renewed
+        self.stop = Event()
+        self.thread = Thread(target=self.heartbeat, daemon=True)
+
+    def acquire(self) -> bool:
+        renewed = monotonic()
+        self.owner = ParticipantProcessingLease.acquire(self.participant_id, self.duration)
+        self.renewed = renewed
+        return self.owner is not None
+
+    def check(self):
+        # (a lease that was not renewed for its duration may have been taken over)
+        if self.lost or monotonic() - self.renewed >= self.duration.total_seconds():
+            raise ProcessingOverlapError(
+                "Lost the processing lease on participant %s, it may be being processed elsewhere."
+                % self.participant_id
+            )
+
+    @contextmanager
+    def holding(self):
+        """ A transaction that is only entered while the lease is held.  The lease is renewed at
+        the start of the transaction, which locks it until the transaction ends, so it cannot be
+        taken over before the writes made inside are committed. """
+        with transaction.atomic():
+            renewed = monotonic()
+            if self.lost or not ParticipantProcessingLease.heartbeat(self.owner, self.duration):
+                self.lost = True
+                self.check()
+            self.renewed = renewed
+            yield
+
+    def heartbeat(self):
+        try:
+            while not self.stop.wait(FILE_PROCESS_LEASE_SECONDS / 3):
+                try:
+                    renewed = monotonic()
+                    if not ParticipantProcessingLease.heartbeat(self.owner, self.duration):
+                        self.lost = True
+                        return
+                    self.renewed = renewed
+                except Exception:
+                    # (e.g. the database connection dropped) try again on the next beat.
+                    traceback.print_exc()
+        finally:
+            # database connections are per-thread, close this thread's before it exits.
+            connections.close_all()
+
+    def __enter__(self):
+        if self.owner is None:
+            raise ProcessingOverlapError("The lease on participant %s was never acquired." % self.participant_id)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop.set()
+        self.thread.join()
+        if not self.lost:
+            ParticipantProcessingLease.release(self.owner)
+
+
+def do_process_user_file_chunks(count: int, error_handler: ErrorHandler, after_id: int,
+                                participant: Participant, lease: ParticipantLease) -> (int, Optional[int]):
     """
     Run through the files to process, pull their data, put it into s3 bins. Run the file through
     the appropriate logic path based on file type.
@@ -96,45 +199,61 @@ def do_process_user_file_chunks(count: int, error_handler: ErrorHandler, skip_co
 
     Any errors are themselves concatenated using the passed in error handler.
 
-    In a single call to this function, count files will be processed, starting from file number
-    skip_count. The first skip_count files are expected to be files that have previously errored
-    in file processing.
+    In a single call to this function, count files will be processed, the first count files
+    (ordered by id) with an id greater than after_id.  Files that fail in file processing are not
+    deleted, passing the id of the last file of the previous page as after_id skips over them.
+    Returns the number of files that failed, and the id of the last file in the page (None if
+    there were no files).
+
+    The participant's lease is checked before every upload and database write (see
+    ParticipantLease), a page stops with a ProcessingOverlapError if the lease was lost.
     """
+    # The cpu pool (if any) is created by the caller, before it starts any threads of its own (such
+    # as a ParticipantLease's), and shut down by the caller when processing is done.
     # Declare a defaultdict containing a tuple of two double ended queues (deque, pronounced "deck")
     all_binified_data = defaultdict(lambda: (deque(), deque()))
     ftps_to_remove = set()
-    # The ThreadPool enables downloading multiple files simultaneously from the network, and continuing
-    # to download files as other files are being processed, making the code as a whole run faster.
-    pool = ThreadPool(CONCURRENT_NETWORK_OPS)
     survey_id_dict = {}
 
-    # A Django query with a slice (e.g. .all()[x:y]) makes a LIMIT query, so it
-    # only gets from the database those FTPs that are in the slice.
-    print(participant.as_native_python())
-    print(len(participant.files_to_process.exclude(deleted=True).all()))
-    print(count)
-    print(skip_count)
-
-    files_to_process = participant.files_to_process.exclude(deleted=True).all()
-
-    for data in pool.map(batch_retrieve_for_processing,
-                         files_to_process[skip_count:count+skip_count],
-                         chunksize=1):
+    # A Django query with a slice (e.g. .all()[:y]) makes a LIMIT query, so it only gets from the
+    # database those FTPs that are in the slice.  The page starts at an id rather than an offset,
+    # the database does not have to count past earlier (failed) files to find it.
+    files_to_process = list(
+        participant.files_to_process.exclude(deleted=True).filter(id__gt=after_id).order_by("id")[:count]
+    )
+    if not files_to_process:
+        return 0, None
+    last_id = files_to_process[-1].id
+    print("%s: %s files, after id %s" % (participant.patient_id, len(files_to_process), after_id))
+
+    # Files pass through a pipeline of stages (download, decrypt, parse/binify), each with its own
+    # threads, connected by bounded queues.  The stages overlap: files are parsed while others are
+    # still downloading, and no stage can run more than FILE_PROCESS_QUEUE_SIZE files ahead of the
+    # next one, which bounds memory.  (see libs.staged_pipeline)
+    downloaded = pipeline_stage(batch_retrieve_for_processing, files_to_process,
+                                FILE_PROCESS_DOWNLOAD_CONCURRENCY, FILE_PROCESS_QUEUE_SIZE)
+    decrypted = pipeline_stage(batch_decrypt_for_processing, downloaded,
+                               FILE_PROCESS_DECRYPT_CONCURRENCY, FILE_PROCESS_QUEUE_SIZE)
+    parsed = pipeline_stage(batch_binify_for_processing, decrypted,
+                            max(FILE_PROCESS_PARSE_CONCURRENCY, FILE_PROCESS_CPU_PROCESSES),
+                            FILE_PROCESS_QUEUE_SIZE)
+
+    for data in parsed:
         with error_handler:
-            # If we encountered any errors in retrieving the files for processing, they have been
-            # lumped together into data['exception']. Raise them here to the error handler and
-            # move to the next file.
+            # If we encountered any errors in retrieving or parsing the files for processing, they
+            # have been lumped together into data['exception']. Raise them here to the error handler
+            # and move to the next file.
             if data['exception']:
                 print("\n" + data['ftp']['s3_file_path'])
                 print(data['traceback'])
                 ################################################################
                 # YOU ARE SEEING THIS EXCEPTION WITHOUT A STACK TRACE
-                # BECAUSE IT OCCURRED INSIDE POOL.MAP ON ANOTHER THREAD
+                # BECAUSE IT OCCURRED INSIDE A PIPELINE STAGE ON ANOTHER THREAD
                 ################################################################
                 raise data['exception']
 
             if data['chunkable']:
-                newly_binified_data, survey_id_hash = process_csv_data(data)
+                newly_binified_data, survey_id_hash = data['binified_data'], data['survey_id_hash']
                 if data['data_type'] in SURVEY_DATA_FILES:
                     survey_id_dict[survey_id_hash] = resolve_survey_id_from_file_name(data['ftp']["s3_file_path"])
 
@@ -149,28 +268,30 @@ def do_process_user_file_chunks(count: int, error_handler: ErrorHandler, skip_co
                 timestamp = clean_java_timecode(data['ftp']["s3_file_path"].rsplit("/", 1)[-1][:-4])
                 # Since we aren't binning the data by hour, just create a ChunkRegistry that
                 # points to the already existing S3 file.
-                ChunkRegistry.register_unchunked_data(
-                    data['data_type'],
-                    timestamp,
-                    data['ftp']['s3_file_path'],
-                    data['ftp']['study'].pk,
-                    data['ftp']['participant'].pk,
-                    data['file_contents'],
-                )
+                with lease.holding():
+                    ChunkRegistry.register_unchunked_data(
+                        data['data_type'],
+                        timestamp,
+                        data['ftp']['s3_file_path'],
+                        data['ftp']['study'].pk,
+                        data['ftp']['participant'].pk,
+                        data['file_contents'],
+                    )
                 ftps_to_remove.add(data['ftp']['id'])
 
-    pool.close()
-    pool.terminate()
-    more_ftps_to_remove, number_bad_files = upload_binified_data(all_binified_data, error_handler, survey_id_dict)
+    more_ftps_to_remove, number_bad_files = upload_binified_data(
+        all_binified_data, error_handler, survey_id_dict, lease
+    )
     ftps_to_remove.update(more_ftps_to_remove)
     # Actually delete the processed FTPs from the database
-    FileToProcess.objects.filter(pk__in=ftps_to_remove).delete()
+    with lease.holding():
+        FileToProcess.objects.filter(pk__in=ftps_to_remove).delete()
     # Garbage collect to free up memory
     gc.collect()
-    return number_bad_files
+    return number_bad_files, last_id
 
 
-def upload_binified_data(binified_data, error_handler, survey_id_dict):
+def upload_binified_data(binified_data, error_handler, survey_id_dict, lease: ParticipantLease):
     """ Takes in binified csv data and handles uploading/downloading+updating
         older data to/from S3 for each chunk.
         Returns a set of concatenations that have succeeded and can be removed.
@@ -178,100 +299,269 @@ def upload_binified_data(binified_data, error_handler, survey_id_dict):
         Raises any errors on the passed in ErrorHandler."""
     failed_ftps = set([])
     ftps_to_retire = set([])
-    upload_these = []
-    for data_bin, (data_rows_deque, ftp_deque) in binified_data.items():
+    upload_errors = []
+
+    # Bins are merged with their existing chunks and uploaded in two more pipeline stages, chunks
+    # are uploaded as soon as they are merged.  Bins are popped off of binified_data as they enter
+    # the merge stage so that the new rows of a bin can be garbage collected once the bin has been
+    # written to its upload buffer.
+    data_bins = list(binified_data.keys())
+    registry_batch = ChunkRegistryBatch(data_bins, survey_id_dict)
+    bins = ((data_bin, binified_data.pop(data_bin)) for data_bin in data_bins)
+    merge = partial(batch_merge_for_upload, survey_id_dict=survey_id_dict, registry_batch=registry_batch)
+    merged = pipeline_stage(merge, bins,
+                            max(FILE_PROCESS_MERGE_CONCURRENCY, FILE_PROCESS_CPU_PROCESSES),
+                            FILE_PROCESS_QUEUE_SIZE)
+    uploaded = pipeline_stage(partial(batch_upload_merged, lease=lease), merged,
+                              FILE_PROCESS_UPLOAD_CONCURRENCY, FILE_PROCESS_QUEUE_SIZE)
+
+    for merged_bin in uploaded:
         with error_handler:
-            try:
-                study_id, user_id, data_type, time_bin, original_header = data_bin
-                # data_rows_deque may be a generator; here it is evaluated
-                rows = list(data_rows_deque)
-                updated_header = convert_unix_to_human_readable_timestamps(original_header, rows)
-                chunk_path = construct_s3_chunk_path(study_id, user_id, data_type, time_bin)
-
-                if ChunkRegistry.objects.filter(chunk_path=chunk_path).exists():
-                    chunk = ChunkRegistry.objects.get(chunk_path=chunk_path)
-                    try:
-                        s3_file_data = s3_retrieve(chunk_path, study_id, raw_path=True)
-                    except OldBotoImportThatNeedsFixingError as e:
-                        # The following check is correct for boto version 2.38.0
-                        if "The specified key does not exist." == e.message:
-                            # This error can only occur if the processing gets actually interrupted and
-                            # data files fail to upload after DB entries are created.
-                            # Encountered this condition 11pm feb 7 2016, cause unknown, there was
-                            # no python stacktrace.  Best guess is mongo blew up.
-                            # If this happened, delete the ChunkRegistry and push this file upload to the next cycle
-                            chunk.remove()
-                            raise ChunkFailedToExist("chunk %s does not actually point to a file, deleting DB entry, should run correctly on next index." % chunk_path)
-                        raise  # Raise original error if not 404 s3 error
-
-                    old_header, old_rows = csv_to_list(s3_file_data)
-
-                    if old_header != updated_header:
-                        # To handle the case where a file was on an hour boundary and placed in
-                        # two separate chunks we need to raise an error in order to retire this file. If this
-                        # happens AND ONE of the files DOES NOT have a header mismatch this may (
-                        # will?) cause data duplication in the chunked file whenever the file
-                        # processing occurs run.
-                        raise HeaderMismatchException('%s\nvs.\n%s\nin\n%s' %
-                                                      (old_header, updated_header, chunk_path) )
-
-                    old_rows = [_ for _ in old_rows]
-                    # This is O(1), which is why we use a deque (double-ended queue)
-                    old_rows.extend(rows)
-                    del rows
-                    ensure_sorted_by_timestamp(old_rows)
-                    new_contents = construct_csv_string(updated_header, old_rows)
-                    del old_rows
-
-                    upload_these.append((chunk, chunk_path, codecs.encode(new_contents, "zip"), study_id))
-                    del new_contents
-                else:
-                    ensure_sorted_by_timestamp(rows)
-                    new_contents = construct_csv_string(updated_header, rows)
-                    if data_type in SURVEY_DATA_FILES:
-                        # We need to keep a mapping of files to survey ids, that is handled here.
-                        survey_id_hash = study_id, user_id, data_type, original_header
-                        survey_id = survey_id_dict[survey_id_hash]
-                    else:
-                        survey_id = None
-                    chunk_params = {
-                        "study_id": study_id,
-                        "user_id": user_id,
-                        "data_type": data_type,
-                        "chunk_path": chunk_path,
-                        "time_bin": time_bin,
-                        "survey_id": survey_id
-                    }
-
-                    upload_these.append((chunk_params, chunk_path, codecs.encode(new_contents, "zip"), study_id))
-            except Exception as e:
+            if merged_bin['exception']:
                 # Here we catch any exceptions that may have arisen, as well as the ones that we raised
                 # ourselves (e.g. HeaderMismatchException). Whichever FTP we were processing when the
                 # exception was raised gets added to the set of failed FTPs.
-                failed_ftps.update(ftp_deque)
-                print(e)
+                failed_ftps.update(merged_bin['ftps'])
+                study_id, user_id, data_type, time_bin, original_header = merged_bin['data_bin']
+                print(merged_bin['exception'])
                 print("FAILED TO UPDATE: study_id:%s, user_id:%s, data_type:%s, time_bin:%s, header:%s "
-                      % (study_id, user_id, data_type, time_bin, updated_header))
-                raise
+                      % (study_id, user_id, data_type, time_bin, original_header))
+                raise merged_bin['exception']
             else:
                 # If no exception was raised, the FTP has completed processing. Add it to the set of
                 # retireable (i.e. completed) FTPs.
-                ftps_to_retire.update(ftp_deque)
+                ftps_to_retire.update(merged_bin['ftps'])
+                if merged_bin['upload']['exception']:
+                    upload_errors.append(merged_bin['upload'])
+                else:
+                    registry_batch.add(merged_bin['upload']['registration'])
+
+    # The ChunkRegistries of every chunk that was uploaded are saved in one transaction, before any
+    # FTPs are deleted.
+    with lease.holding():
+        registry_batch.commit()
 
-    pool = ThreadPool(CONCURRENT_NETWORK_OPS)
-    errors = pool.map(batch_upload, upload_these, chunksize=1)
-    for err_ret in errors:
-        if err_ret['exception']:
-            print(err_ret['traceback'])
-            raise err_ret['exception']
+    for err_ret in upload_errors:
+        print(err_ret['traceback'])
+        raise err_ret['exception']
 
-    pool.close()
-    pool.terminate()
     # The things in ftps to retire that are not in failed ftps.
     # len(failed_ftps) will become the number of files to skip in the next iteration.
     return ftps_to_retire.difference(failed_ftps), len(failed_ftps)
 
 
+def merge_binified_data(data_bin: tuple, data_rows_deque: deque, survey_id_dict: dict,
+                        registry_batch: "ChunkRegistryBatch") -> tuple:
+    """ Merges the new rows of a bin with the contents of its existing chunk, if there is one.
+        Returns the tuple that batch_upload takes. """
+    study_id, user_id, data_type, time_bin, original_header = data_bin
+    chunk_path = construct_s3_chunk_path(study_id, user_id, data_type, time_bin)
+    chunk = registry_batch.get_existing_chunk(chunk_path)
+
+    if chunk is not None:
+        try:
+            old_chunk_contents = s3_retrieve(chunk_path, study_id, raw_path=True)
+        except OldBotoImportThatNeedsFixingError as e:
+            # The following check is correct for boto version 2.38.0
+            if "The specified key does not exist." == e.message:
+                # This error can only occur if the processing gets actually interrupted and
+                # data files fail to upload after DB entries are created.
+                # Encountered this condition 11pm feb 7 2016, cause unknown, there was
+                # no python stacktrace.  Best guess is mongo blew up.
+                # If this happened, delete the ChunkRegistry and push this file upload to the next cycle
+                chunk.remove()
+                raise ChunkFailedToExist("chunk %s does not actually point to a file, deleting DB entry, should run correctly on next index." % chunk_path)
+            raise  # Raise original error if not 404 s3 error
+    else:
+        old_chunk_contents = None
+
+    # data_rows_deque may be a generator; here it is evaluated
+    if cpu_pool is None:
+        new_contents = build_chunk_contents(original_header, list(data_rows_deque), old_chunk_contents, chunk_path)
+    else:
+        new_contents = cpu_pool.apply(
+            build_chunk_contents_from_transfer,
+            (original_header, list(data_rows_deque), old_chunk_contents, chunk_path)
+        )
+    del data_rows_deque, old_chunk_contents
+
+    if chunk is not None:
+        return chunk, chunk_path, new_contents, study_id
+
+    if data_type in SURVEY_DATA_FILES:
+        # We need to keep a mapping of files to survey ids, that is handled here.
+        survey_id_hash = study_id, user_id, data_type, original_header
+        survey_id = survey_id_dict[survey_id_hash]
+    else:
+        survey_id = None
+    # Convert the ID's used in the S3 file names into primary keys for making ChunkRegistry FKs
+    participant_pk, study_pk = registry_batch.get_participant_pks(user_id)
+    chunk_params = {
+        "study_id": study_id,
+        "user_id": user_id,
+        "data_type": data_type,
+        "chunk_path": chunk_path,
+        "time_bin": time_bin,
+        "survey_id": survey_id,
+        "participant_pk": participant_pk,
+        "study_pk": study_pk,
+        "survey_pk": registry_batch.get_survey_pk(survey_id) if survey_id else None,
+    }
+    return chunk_params, chunk_path, new_contents, study_id
+
+
+class ChunkRegistryBatch(object):
+    """
+    The ChunkRegistry database work of one page of file processing.  The existing ChunkRegistries
+    of the page's chunks, and the participant and survey primary keys that new ChunkRegistries
+    need, are each fetched with one query up front; new and updated ChunkRegistries are collected
+    with add() and saved together by commit().
+    The lookups are made from pipeline stage threads, add() and commit() on the main thread.
+    """
+
+    def __init__(self, data_bins: List[tuple], survey_id_dict: dict):
+        self.existing_chunks = ChunkRegistry.get_by_chunk_paths(
+            [construct_s3_chunk_path(*data_bin[:4]) for data_bin in data_bins]
+        )
+        self.participant_pks = {
+            patient_id: (participant_pk, study_pk) for patient_id, participant_pk, study_pk in
+            Participant.objects.filter(patient_id__in={data_bin[1] for data_bin in data_bins})
+                .values_list('patient_id', 'pk', 'study_id')
+        }
+        self.survey_pks = dict(
+            Survey.objects.filter(object_id__in=set(survey_id_dict.values())).values_list('object_id', 'pk')
+        )
+        self.new_chunks = []
+        self.updated_chunks = []
+
+    def get_existing_chunk(self, chunk_path: str) -> Optional[ChunkRegistry]:
+        chunks = self.existing_chunks.get(chunk_path, [])
+        if len(chunks) > 1:
+            raise ChunkRegistry.MultipleObjectsReturned(
+                "%s ChunkRegistries have the chunk path %s" % (len(chunks), chunk_path)
+            )
+        return chunks[0] if chunks else None
+
+    def get_participant_pks(self, patient_id: str) -> (int, int):
+        """ Returns the participant's pk and their study's pk. """
+        try:
+            return self.participant_pks[patient_id]
+        except KeyError:
+            raise Participant.DoesNotExist("no participant with patient id %s" % patient_id)
+
+    def get_survey_pk(self, survey_object_id: str) -> int:
+        try:
+            return self.survey_pks[survey_object_id]
+        except KeyError:
+            raise Survey.DoesNotExist("no survey with object id %s" % survey_object_id)
+
+    def add(self, chunk: ChunkRegistry):
+        if chunk.pk is None:
+            self.new_chunks.append(chunk)
+        else:
+            self.updated_chunks.append(chunk)
+
+    def commit(self):
+        ChunkRegistry.bulk_register(self.new_chunks, self.updated_chunks)
+        self.new_chunks = []
+        self.updated_chunks = []
+
+
+def build_chunk_contents(original_header: bytes, rows: list, old_chunk_contents: Optional[bytes],
+                         chunk_path: str) -> ChunkBuffer:
+    """ Adds the human readable timestamp column to the new rows of a bin, merges them into the
+        rows of the existing chunk (if there is one), and returns the chunk csv.
+        Makes no database or network calls, so that it can be run on the cpu pool. """
+    updated_header = convert_unix_to_human_readable_timestamps(original_header, rows)
+    ensure_sorted_by_timestamp(rows)
+
+    if old_chunk_contents is None:
+        return write_csv_rows(updated_header, merge_sorted_csv_rows(rows))
+
+    old_header, old_rows = csv_to_list(old_chunk_contents)
+    del old_chunk_contents
+
+    if old_header != updated_header:
+        # To handle the case where a file was on an hour boundary and placed in
+        # two separate chunks we need to raise an error in order to retire this file. If this
+        # happens AND ONE of the files DOES NOT have a header mismatch this may (
+        # will?) cause data duplication in the chunked file whenever the file
+        # processing occurs run.
+        raise HeaderMismatchException('%s\nvs.\n%s\nin\n%s' %
+                                      (old_header, updated_header, chunk_path) )
+
+    old_rows = [_ for _ in old_rows]
+    # Existing chunks were written sorted, on a sorted list this is a single pass.
+    ensure_sorted_by_timestamp(old_rows)
+    # The two sorted runs are merged and deduplicated on the fly, and written
+    # directly into the upload buffer; the merged csv is never held in memory
+    # in its entirety.
+    return write_csv_rows(updated_header, merge_sorted_csv_rows(old_rows, rows))
+
+
+"""################################ CPU Pool ################################"""
+
+
+def get_cpu_pool():
+    """ Returns the process pool for csv parsing and merging, None if FILE_PROCESS_CPU_PROCESSES is
+        not set.  The processes are forked on the first call, which must happen before any threads
+        are started (a forked process only gets the thread that forked it, locks held by other
+        threads at the time stay locked in the forked process forever).  Call close_cpu_pool when
+        processing is done.
+
+        This is a billiard (celery's fork of multiprocessing) pool: the processes of the prefork
+        celery worker are daemonic, and multiprocessing does not allow daemonic processes to have
+        children. """
+    global cpu_pool
+    if cpu_pool is None and FILE_PROCESS_CPU_PROCESSES:
+        # billiard is installed with celery, which only the data processing servers have.
+        from billiard import Pool
+        # The children would inherit the sockets of open database connections, which must not be
+        # used from two processes.  (The pool's work makes no database calls.)
+        connections.close_all()
+        cpu_pool = Pool(FILE_PROCESS_CPU_PROCESSES)
+    return cpu_pool
+
+
+def close_cpu_pool():
+    global cpu_pool
+    if cpu_pool is not None:
+        cpu_pool.terminate()
+        cpu_pool.join()
+        cpu_pool = None
+
+
+# Everything passed to and from the cpu pool is pickled.  Pickling millions of small objects (a row
+# is a list of bytes) would cost about as much as the parsing itself, so rows cross the process
+# boundary as a few large byte strings of joined rows, which pickle as a plain copy.  This
+# round-trips exactly: fields never contain commas or line breaks, because the rows were produced
+# by splitting lines on them (csv_to_list).
+
+
+def rows_to_transfer(rows: Iterable[list]) -> bytes:
+    return b"\n".join(b",".join(row) for row in rows)
+
+
+def rows_from_transfer(transfers: Iterable[bytes]) -> list:
+    return [row.split(b",") for transfer in transfers for row in transfer.split(b"\n")]
+
+
+def binify_csv_file_for_transfer(csv_file: dict) -> (dict, tuple):
+    """ Runs binify_csv_file on the cpu pool. """
+    binified_data, survey_id_hash = binify_csv_file(csv_file)
+    if binified_data is None:
+        return None, None
+    return {data_bin: rows_to_transfer(rows) for data_bin, rows in binified_data.items()}, survey_id_hash
+
+
+def build_chunk_contents_from_transfer(original_header: bytes, transfers: List[bytes],
+                                       old_chunk_contents: Optional[bytes], chunk_path: str) -> ChunkBuffer:
+    """ Runs build_chunk_contents on the cpu pool. """
+    rows = rows_from_transfer(transfers)
+    del transfers
+    return build_chunk_contents(original_header, rows, old_chunk_contents, chunk_path)
+
+
 """################################ S3 Stuff ################################"""
 
 
@@ -316,33 +606,35 @@ def file_path_to_data_type(file_path: str):
     raise Exception("data type unknown: %s" % file_path)
 
 
+def timestamp_sort_key(row: list) -> int:
+    return int(row[0])
+
+
 def ensure_sorted_by_timestamp(l: list):
     """ According to the docs the sort method on a list is in place and should
         faster, this is how to declare a sort by the first column (timestamp). """
-    l.sort(key=lambda x: int(x[0]))
+    l.sort(key=timestamp_sort_key)
 
 
 def convert_unix_to_human_readable_timestamps(header: bytes, rows: list) -> List[bytes]:
     """ Adds a new column to the end which is the unix time represented in
     a human readable time format.  Returns an appropriately modified header. """
+    # strftime is by far the most expensive operation here.  All rows of a chunk fall within the
+    # same hour and sensor streams record many rows per second, so each second is formatted once
+    # and memoized; the (0-padded) millisecond suffixes come from a lookup table.
+    second_strings = {}
     for row in rows:
-        unix_millisecond = int(row[0])
-        time_string = unix_time_to_string(unix_millisecond // 1000)
-        # this line 0-pads millisecond values that have leading 0s.
-        time_string += b".%03d" % (unix_millisecond % 1000)
-        row.insert(1, time_string)
+        unix_second, millisecond = divmod(int(row[0]), 1000)
+        second_string = second_strings.get(unix_second)
+        if second_string is None:
+            second_string = second_strings[unix_second] = unix_time_to_string(unix_second)
+        # (inserting into a short list is cheaper than rebuilding it)
+        row.insert(1, second_string + MILLISECOND_SUFFIXES[millisecond])
     header = header.split(b",")
     header.insert(1, b"UTC time")
     return b",".join(header)
 
 
-def binify_from_timecode(unix_ish_time_code_string: bytes) -> int:
-    """ Takes a unix-ish time code (accepts unix millisecond), and returns an
-        integer value of the bin it should go in. """
-    actually_a_timecode = clean_java_timecode(unix_ish_time_code_string)  # clean java time codes...
-    return actually_a_timecode // CHUNK_TIMESLICE_QUANTUM #separate into nice, clean hourly chunks!
-
-
 def resolve_survey_id_from_file_name(name: str) -> str:
     return name.rsplit("/", 2)[1]
 
@@ -356,11 +648,26 @@ def binify_csv_rows(rows_list: list, study_id: str, user_id: str, data_type: str
         value of the entry's unix(ish) timestamp. (based CHUNK_TIMESLICE_QUANTUM)
         Returns a dict of form {(study_id, user_id, data_type, time_bin, header):rows_lists}. """
     ret = defaultdict(deque)
+    # Data files are (almost always) in time order, so rows are collected in runs of consecutive
+    # rows that share a bin, in effect splitting the file at its bin boundaries.  The bin dict,
+    # whose 5-tuple keys are expensive to hash, is then touched once per run instead of once per
+    # row.  The bin of a row is its unix time (the seconds of its unix(ish) millisecond timestamp,
+    # as in clean_java_timecode), rounded down to CHUNK_TIMESLICE_QUANTUM.
+    run = []
+    run_bin = None
     for row in rows_list:
         # discovered August 7 2017, looks like there was an empty line at the end
         # of a file? row was a [''].
         if row and row[0]:
-            ret[(study_id, user_id, data_type, binify_from_timecode(row[0]), header)].append(row)
+            time_bin = int(row[0][:10]) // CHUNK_TIMESLICE_QUANTUM
+            if time_bin != run_bin:
+                if run:
+                    ret[(study_id, user_id, data_type, run_bin, header)].extend(run)
+                run = []
+                run_bin = time_bin
+            run.append(row)
+    if run:
+        ret[(study_id, user_id, data_type, run_bin, header)].extend(run)
     return ret
 
 
@@ -379,38 +686,59 @@ def process_csv_data(data: dict):
     """ Constructs a binified dict of a given list of a csv rows,
         catches csv files with known problems and runs the correct logic.
         Returns None If the csv has no data in it. """
-    participant = data['ftp']['participant']
+    # the file contents are moved out of data, so that they are freed as soon as they are parsed.
+    csv_file = {
+        "file_contents": data.pop('file_contents'),
+        "data_type": data['data_type'],
+        "file_path": data['ftp']['s3_file_path'],
+        "os_type": data['ftp']['participant'].os_type,
+        "study_id": data['ftp']['study'].object_id.encode(),
+        "user_id": data['ftp']['participant'].patient_id,
+    }
+    if cpu_pool is None:
+        return binify_csv_file(csv_file)
+
+    binified_data, survey_id_hash = cpu_pool.apply(binify_csv_file_for_transfer, (csv_file,))
+    del csv_file
+    if binified_data is None:
+        return None, None
+    # (these become the rows of the bins in upload_binified_data, see append_binified_csvs)
+    return {data_bin: [transfer] for data_bin, transfer in binified_data.items()}, survey_id_hash
+
 
-    if participant.os_type == Participant.ANDROID_API:
+def binify_csv_file(csv_file: dict):
+    """ The work of process_csv_data, makes no database or network calls so that it can be run on
+        the cpu pool.  csv_file is a dict of plain values (see process_csv_data). """
+    if csv_file['os_type'] == Participant.ANDROID_API:
         # Do fixes for Android
-        if data["data_type"] == ANDROID_LOG_FILE:
-            data['file_contents'] = fix_app_log_file(data['file_contents'], data['ftp']['s3_file_path'])
+        if csv_file["data_type"] == ANDROID_LOG_FILE:
+            csv_file['file_contents'] = fix_app_log_file(csv_file['file_contents'], csv_file['file_path'])
 
-        header, csv_rows_list = csv_to_list(data['file_contents'])
-        if data["data_type"] != ACCELEROMETER:
+        header, csv_rows_list = csv_to_list(csv_file['file_contents'])
+        if csv_file["data_type"] != ACCELEROMETER:
             # If the data is not accelerometer data, convert the generator to a list.
             # For accelerometer data, the data is massive and so we don't want it all
             # in memory at once.
             csv_rows_list = [r for r in csv_rows_list]
 
-        if data["data_type"] == CALL_LOG:
+        if csv_file["data_type"] == CALL_LOG:
             header = fix_call_log_csv(header, csv_rows_list)
-        if data["data_type"] == WIFI:
-            header = fix_wifi_csv(header, csv_rows_list, data['ftp']['s3_file_path'])
+        if csv_file["data_type"] == WIFI:
+            header = fix_wifi_csv(header, csv_rows_list, csv_file['file_path'])
     else:
         # Do fixes for iOS
-        header, csv_rows_list = csv_to_list(data['file_contents'])
-        if data["data_type"] != ACCELEROMETER:
+        header, csv_rows_list = csv_to_list(csv_file['file_contents'])
+        if csv_file["data_type"] != ACCELEROMETER:
             csv_rows_list = [r for r in csv_rows_list]
 
     # Memory saving measure: this data is now stored in its entirety in csv_rows_list
-    del data['file_contents']
+    del csv_file['file_contents']
 
     # Do these fixes for data whether from Android or iOS
-    if data["data_type"] == IDENTIFIERS:
-        header = fix_identifier_csv(header, csv_rows_list, data['ftp']['s3_file_path'])
-    if data["data_type"] == SURVEY_TIMINGS:
-        header = fix_survey_timings(header, csv_rows_list, data['ftp']['s3_file_path'])
+    if csv_file["data_type"] == IDENTIFIERS:
+        header = fix_identifier_csv(header, csv_rows_list, csv_file['file_path'])
+    if csv_file["data_type"] == SURVEY_TIMINGS:
+        header = fix_survey_timings(header, csv_rows_list, csv_file['file_path'])
 
     header = b",".join([column_name.strip() for column_name in header.split(b",")])
     if csv_rows_list:
@@ -418,13 +746,13 @@ def process_csv_data(data: dict):
             # return item 1: the data as a defaultdict
             binify_csv_rows(
                 csv_rows_list,
-                data['ftp']['study'].object_id.encode(),
-                data['ftp']['participant'].patient_id,
-                data["data_type"],
+                csv_file['study_id'],
+                csv_file['user_id'],
+                csv_file["data_type"],
                 header
             ),
             # return item 2: the tuple that we use as a key for the defaultdict
-            (data['ftp']['study'].object_id.encode(), data['ftp']['participant'].patient_id, data["data_type"], header)
+            (csv_file['study_id'], csv_file['user_id'], csv_file["data_type"], header)
         )
     else:
         return None, None
@@ -536,37 +864,44 @@ def csv_to_list(csv_string: bytes) -> (bytes, Generator):
     return header, split_yielder(lines)
 
 
-def construct_csv_string(header: bytes, rows_list: List[bytes]) -> bytes:
-    """ Takes a header list and a csv and returns a single string of a csv.
-        Now handles unicode errors.  :D :D :D """
-    # The old, compact list comprehension was, it turned out, both nonperformant and of an
-    # incomprehensible memory order. This is ~1.5x faster, and has a much clearer memory order.
-
-    def deduplicate(seq):
-        # highly optimized order preserving deduplication function.
-        seen = set()
-        seen_add = seen.add
-        return [x for x in seq if not (x in seen or seen_add(x))]
-
-    rows = []
-    for row_items in rows_list:
-
-        try:
-            rows.append(b",".join(row_items))
-        except TypeError:
-            print("######################################################################3")
-            pprint(row_items)
-            print("######################################################################3")
-            raise
-
-    del rows_list, row_items
-
-    # we need to ensure no duplicates
-    rows = deduplicate(rows)
-    ret = header
+def merge_sorted_csv_rows(*sorted_rows_lists: List[list]) -> Generator[bytes, None, None]:
+    """ K-way merges lists of csv rows that are each already sorted by timestamp, yields every
+    distinct row joined into a line.  Output is identical to concatenating the lists, sorting them
+    by timestamp and deduplicating the lines, but only the lines of the current timestamp are held
+    in memory: identical lines always share a timestamp.
+    (See scripts/benchmark_write_csv_rows.py.) """
+    current_timestamp = None
+    seen = set()
+    seen_add = seen.add
+    # heapq.merge is stable, rows with equal timestamps come out in the order of the input lists.
+    for row_items in heapq.merge(*sorted_rows_lists, key=timestamp_sort_key):
+        timestamp = int(row_items[0])
+        if timestamp != current_timestamp:
+            current_timestamp = timestamp
+            seen.clear()
+
+        row = b",".join(row_items)
+        if row not in seen:
+            seen_add(row)
+            yield row
+
+
+def write_csv_rows(header: bytes, rows: Iterable[bytes]) -> ChunkBuffer:
+    """ Writes the header and rows of a csv into a ChunkBuffer in batches, so the csv is never
+    constructed as a whole in memory. """
+    chunk_buffer = ChunkBuffer()
+    chunk_buffer.write(header)
+    batch = []
     for row in rows:
-        ret += b"\n" + row
-    return ret
+        batch.append(row)
+        if len(batch) == CSV_WRITE_BATCH_SIZE:
+            chunk_buffer.write(b"\n" + b"\n".join(batch))
+            batch = []
+    if batch:
+        chunk_buffer.write(b"\n" + b"\n".join(batch))
+    del batch
+    chunk_buffer.finish()
+    return chunk_buffer
 
 
 def clean_java_timecode(java_time_code_string: bytes) -> int:
@@ -599,10 +934,10 @@ def batch_retrieve_for_processing(ftp_as_object: FileToProcess) -> dict:
     }
 
     # Try to retrieve the file contents. If any errors are raised, store them to be raised by the
-    # parent function
+    # parent function.  The contents are decrypted in the next stage, batch_decrypt_for_processing.
     try:
         print(ftp['s3_file_path'] + ", getting data...")
-        ret['file_contents'] = s3_retrieve(ftp['s3_file_path'], ftp["study"].object_id.encode(), raw_path=True)
+        ret['file_contents'] = s3_retrieve_encrypted(ftp['s3_file_path'], ftp["study"].object_id, raw_path=True)
     except Exception as e:
         traceback.print_exc()
         ret['traceback'] = sys.exc_info()
@@ -610,9 +945,59 @@ def batch_retrieve_for_processing(ftp_as_object: FileToProcess) -> dict:
     return ret
 
 
-def batch_upload(upload: Tuple[dict, str, bytes, str]):
+def batch_decrypt_for_processing(data: dict) -> dict:
+    """ Used for mapping decryption over the output of batch_retrieve_for_processing. """
+    if data['exception']:
+        return data
+    try:
+        data['file_contents'] = decrypt_server(data['file_contents'], data['ftp']["study"].object_id)
+    except Exception as e:
+        traceback.print_exc()
+        data['traceback'] = sys.exc_info()
+        data['exception'] = e
+    return data
+
+
+def batch_binify_for_processing(data: dict) -> dict:
+    """ Used for mapping process_csv_data over the output of batch_decrypt_for_processing. """
+    if data['exception'] or not data['chunkable']:
+        return data
+    try:
+        data['binified_data'], data['survey_id_hash'] = process_csv_data(data)
+    except Exception as e:
+        traceback.print_exc()
+        data['traceback'] = sys.exc_info()
+        data['exception'] = e
+    return data
+
+
+def batch_merge_for_upload(binified_item: Tuple[tuple, Tuple[deque, deque]], survey_id_dict: dict,
+                           registry_batch: ChunkRegistryBatch) -> dict:
+    """ Used for mapping merge_binified_data over binified data, the ftps of the bin are passed on.
+        The item is unpacked, can only have one parameter. """
+    data_bin, (data_rows_deque, ftp_deque) = binified_item
+    del binified_item
+    ret = {'data_bin': data_bin, 'ftps': ftp_deque, 'upload': None, 'exception': None, 'traceback': None}
+    try:
+        ret['upload'] = merge_binified_data(data_bin, data_rows_deque, survey_id_dict, registry_batch)
+    except Exception as e:
+        traceback.print_exc()
+        ret['traceback'] = sys.exc_info()
+        ret['exception'] = e
+    return ret
+
+
+def batch_upload_merged(merged_bin: dict, lease: ParticipantLease) -> dict:
+    """ Used for mapping batch_upload over the output of batch_merge_for_upload, the result of the
+        upload replaces merged_bin['upload']. """
+    if not merged_bin['exception']:
+        merged_bin['upload'] = batch_upload(merged_bin['upload'], lease)
+    return merged_bin
+
+
+def batch_upload(upload: Tuple[dict, str, ChunkBuffer, str], lease: ParticipantLease) -> dict:
     """ Used for mapping an s3_upload function.  the tuple is unpacked, can only have one parameter. """
-    ret = {'exception': None, 'traceback': None}
+    ret = {'exception': None, 'traceback': None, 'registration': None}
     try:
         if len(upload) != 4:
             # upload should have length 4; this is for debugging if it doesn't
@@ -623,31 +1008,37 @@ def batch_upload(upload: Tuple[dict, str, bytes, str]):
         if "b'" in chunk_path:
             raise Exception(chunk_path)
 
-        s3_upload(chunk_path, codecs.decode(new_contents, "zip"), study_object_id, raw_path=True)
+        # the chunk on s3 is only overwritten while the participant's lease is held.
+        lease.check()
+        # new_contents is a ChunkBuffer of the csv, it is hashed, encrypted and uploaded in parts,
+        # so the csv is never held in memory as a whole.
+        md5 = hashlib.md5()
+        file_size = s3_upload_stream(
+            chunk_path, hash_parts(new_contents.iter_contents(), md5), study_object_id, raw_path=True
+        )
+        new_contents.close()
+        contents_hash = encode_chunk_hash(md5).decode()
         print("data uploaded!", chunk_path)
 
+        # The ChunkRegistry is saved later, by the page's ChunkRegistryBatch.
         if isinstance(chunk, ChunkRegistry):
             # If the contents are being appended to an existing ChunkRegistry object
-            chunk.file_size = len(new_contents)
-            chunk.update_chunk_hash(new_contents)
+            chunk.file_size = file_size
+            chunk.chunk_hash = contents_hash
+            ret['registration'] = chunk
 
         else:
             # If a new ChunkRegistry object is being created
-            # Convert the ID's used in the S3 file names into primary keys for making ChunkRegistry FKs
-            participant_pk, study_pk = Participant.objects.filter(patient_id=chunk['user_id']).values_list('pk', 'study_id').get()
-            if chunk['survey_id']:
-                survey_pk = Survey.objects.filter(object_id=chunk['survey_id']).values_list('pk', flat=True).get()
-            else:
-                survey_pk = None
-
-            ChunkRegistry.register_chunked_data(
+            ret['registration'] = ChunkRegistry.build_chunked_data(
                 chunk['data_type'],
                 chunk['time_bin'],
                 chunk['chunk_path'],
-                new_contents,  # unlikely to be huge
-                study_pk,
-                participant_pk,
-                survey_pk,
+                None,
+                chunk['study_pk'],
+                chunk['participant_pk'],
+                chunk['survey_pk'],
+                file_size=file_size,
+                chunk_hash_str=contents_hash,
             )
 
     # it broke. print stacktrace for debugging
@@ -659,6 +1050,13 @@ def batch_upload(upload: Tuple[dict, str, bytes, str]):
     return ret
 
 
+def hash_parts(parts: Iterable[bytes], md5) -> Generator[bytes, None, None]:
+    """ Passes parts through, updating md5 with each. """
+    for part in parts:
+        md5.update(part)
+        yield part
+
+
 """ Exceptions """
 class HeaderMismatchException(Exception): pass
 class ChunkFailedToExist(Exception): pass
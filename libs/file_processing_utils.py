@@ -40,16 +40,11 @@ def reindex_all_files_to_process():
     
     # For each such file, create an FTP object
     print("putting new files to process...")
-    for i, l in enumerate(files_lists):
-        print('{!s} {:d} of {:d}, {:d} files'.format(datetime.now(), i + 1, Study.objects.count(), len(l)))
-        for fp in l:
-            if fp[-4:] in PROCESSABLE_FILE_EXTENSIONS:
-                patient_id = fp.split('/', 2)[1]
-                participant_pk = Participant.objects.filter(patient_id=patient_id).values_list('pk', flat=True).get()
-                FileToProcess.append_file_for_processing(fp, fp.split("/", 1)[0], participant_id=participant_pk)
+    count = FileToProcess.append_files_for_processing(files_to_process_from_s3_file_lists(files_lists))
+    print('{!s} added {:d} files'.format(datetime.now(), count))
     
     # Clean up by deleting large variables, closing the thread pool and unlocking the file process lock
-    del files_lists, l
+    del files_lists
     pool.close()
     pool.terminate()
     FileProcessLock.unlock()
@@ -80,15 +75,10 @@ def reindex_specific_data_type(data_type):
 
     print("pulling files to process...")
     files_lists = pool.map(s3_list_files, Study.objects.values_list('object_id', flat=True))
-    for i, l in enumerate(files_lists):
-        print('{!s} {:d} of {:d}, {:d} files'.format(datetime.now(), i + 1, Study.objects.count(), len(l)))
-        for fp in l:
-            if fp[-4:] in PROCESSABLE_FILE_EXTENSIONS:
-                patient_id = fp.split('/', 2)[1]
-                participant_pk = Participant.objects.filter(patient_id=patient_id).values_list('pk', flat=True).get()
-                FileToProcess.append_file_for_processing(fp, fp.split("/", 1)[0], participant_id=participant_pk)
+    count = FileToProcess.append_files_for_processing(files_to_process_from_s3_file_lists(files_lists))
+    print('{!s} added {:d} files'.format(datetime.now(), count))
 
-    del files_lists, l
+    del files_lists
     pool.close()
     pool.terminate()
     FileProcessLock.unlock()
@@ -98,6 +88,17 @@ def reindex_specific_data_type(data_type):
     print("Done.")
 
 
+def files_to_process_from_s3_file_lists(files_lists):
+    """ Takes lists of s3 file paths, yields the processable ones in the form that
+        FileToProcess.append_files_for_processing takes. """
+    # {patient_id: participant pk}, one query instead of one per file.
+    participant_pks = dict(Participant.objects.values_list('patient_id', 'pk'))
+    for file_list in files_lists:
+        for fp in file_list:
+            if fp[-4:] in PROCESSABLE_FILE_EXTENSIONS:
+                yield fp, fp.split("/", 1)[0], participant_pks[fp.split('/', 2)[1]]
+
+
 # def reindex_study(study_id):
 #     if isinstance(study_id, (str, unicode)):
 #         study_id = ObjectId(study_id)
@@ -1,7 +1,14 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Iterable
+
 import boto3
 import Crypto
+from boto3.s3.transfer import TransferConfig
 
-from config.constants import DEFAULT_S3_RETRIES
+from config.constants import (CLIENT_KEY_CACHE_SECONDS, CLIENT_KEY_CACHE_SIZE, DEFAULT_S3_RETRIES,
+    EXPORT_ARCHIVES_FOLDER)
 from config.settings import (BEIWE_SERVER_AWS_ACCESS_KEY_ID, BEIWE_SERVER_AWS_SECRET_ACCESS_KEY,
     S3_BUCKET, S3_REGION_NAME)
 from libs import encryption
@@ -15,21 +22,88 @@ conn = boto3.client('s3',
                     region_name=S3_REGION_NAME)
 
 
-def s3_upload(key_path: str, data_string: bytes, study_object_id: str, raw_path=False) -> None:
+def s3_upload(key_path: str, data_string: bytes, study_object_id: str, raw_path=False) -> int:
+    """ Encrypts and uploads data_string, returns the size of the stored (encrypted) file. """
     if not raw_path:
         key_path = study_object_id + "/" + key_path
     data = encryption.encrypt_for_server(data_string, study_object_id)
     conn.put_object(Body=data, Bucket=S3_BUCKET, Key=key_path)#, ContentType='string')
+    return len(data)
 
 
-def s3_retrieve(key_path, study_object_id, raw_path=False, number_retries=DEFAULT_S3_RETRIES) -> bytes:
+def s3_upload_stream(key_path: str, parts: Iterable[bytes], study_object_id: str, raw_path=False) -> int:
+    """ As s3_upload, but the data is provided in parts, which are encrypted and uploaded as they
+    are read (large files in a multipart upload), so the data is never held in memory at once.
+    Returns the size of the stored (encrypted) file. """
+    if not raw_path:
+        key_path = study_object_id + "/" + key_path
+    encrypted_file = _EncryptingReader(parts, study_object_id)
+    # callers upload on threads of their own, each upload holds one part in memory.
+    conn.upload_fileobj(encrypted_file, S3_BUCKET, key_path, Config=TransferConfig(use_threads=False))
+    return encrypted_file.size
+
+
+class _EncryptingReader(object):
+    """ A file object of the encrypt_for_server output of parts, for s3_upload_stream. """
+
+    def __init__(self, parts: Iterable[bytes], study_object_id: str):
+        iv, self.encryptor = encryption.server_encryptor(study_object_id)
+        self.parts = iter(parts)
+        self.buffer = bytearray(iv)
+        self.size = 0
+
+    def read(self, size=-1) -> bytes:
+        while self.parts is not None and (size < 0 or len(self.buffer) < size):
+            part = next(self.parts, None)
+            if part is None:
+                self.parts = None
+            else:
+                self.buffer += self.encryptor.encrypt(part)
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self.size += len(data)
+        return data
+
+
+def s3_retrieve(key_path, study_object_id, raw_path=False, number_retries=DEFAULT_S3_RETRIES,
+                encryption_key: bytes = None) -> bytes:
     """ Takes an S3 file path (key_path), and a study ID.  Takes an optional argument, raw_path,
     which defaults to false.  When set to false the path is prepended to place the file in the
-    appropriate study_id folder. """
+    appropriate study_id folder.  Callers that already have the study's encryption_key can
+    provide it. """
+    encrypted_data = s3_retrieve_encrypted(key_path, study_object_id, raw_path=raw_path,
+                                           number_retries=number_retries)
+    return encryption.decrypt_server(encrypted_data, study_object_id, encryption_key=encryption_key)
+
+
+def s3_retrieve_encrypted(key_path, study_object_id, raw_path=False, number_retries=DEFAULT_S3_RETRIES) -> bytes:
+    """ As s3_retrieve, but does not decrypt the data (see encryption.decrypt_server). """
+    if not raw_path:
+        key_path = study_object_id + "/" + key_path
+    return _do_retrieve(S3_BUCKET, key_path, number_retries=number_retries)['Body'].read()
+
+
+def s3_upload_encrypted_file(key_path: str, file_path: str):
+    """ Uploads a file that is already encrypted (see encryption.server_encryptor), in parts, so the
+    file can be larger than memory.  key_path is the full (raw) path. """
+    conn.upload_file(file_path, S3_BUCKET, key_path)
+
+
+def s3_retrieve_stream(key_path, study_object_id, raw_path=False, encryption_key: bytes = None,
+                       block_size=1024*1024):
+    """ As s3_retrieve, but a generator of the decrypted data in parts of (up to) block_size, for
+    files larger than memory. """
     if not raw_path:
         key_path = study_object_id + "/" + key_path
-    encrypted_data = _do_retrieve(S3_BUCKET, key_path, number_retries=number_retries)['Body'].read()
-    return encryption.decrypt_server(encrypted_data, study_object_id)
+    body = _do_retrieve(S3_BUCKET, key_path)['Body']
+    try:
+        decryptor = encryption.server_decryptor(body.read(16), study_object_id, encryption_key)
+        for block in iter(lambda: body.read(block_size), b""):
+            yield decryptor.decrypt(block)
+    finally:
+        body.close()
 
 
 def _do_retrieve(bucket_name, key_path, number_retries=DEFAULT_S3_RETRIES):
@@ -108,6 +182,21 @@ def _do_list_files_generator(page_iterator):
 def s3_delete(key_path):
     raise Exception("NO DONT DELETE")
 
+
+def s3_delete_export_archive(key_path: str, old_versions_only=False):
+    """ s3_delete is disabled so that data can never be deleted by mistake.  Export archives are
+    only a copy of data stored elsewhere (see libs.export_archives), this deletes them, and refuses
+    any other path.  All versions of the file are deleted (in a versioned bucket a plain delete
+    keeps them), or with old_versions_only all but the current one. """
+    if "/%s/" % EXPORT_ARCHIVES_FOLDER not in key_path:
+        raise Exception("NO DONT DELETE")
+    paginator = conn.get_paginator('list_object_versions')
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=key_path):
+        for version in page.get('Versions', []):
+            if version['Key'] != key_path or (old_versions_only and version['IsLatest']):
+                continue
+            conn.delete_object(Bucket=S3_BUCKET, Key=key_path, VersionId=version['VersionId'])
+
 ################################################################################
 ######################### Client Key Management ################################
 ################################################################################
@@ -117,6 +206,8 @@ def create_client_key_pair(patient_id, study_id):
     public, private = encryption.generate_key_pairing()
     s3_upload("keys/" + patient_id + "_private", private, study_id)
     s3_upload("keys/" + patient_id + "_public", public, study_id)
+    invalidate_client_private_key(patient_id)
+    encryption.invalidate_device_keys(patient_id)
 
 
 def get_client_public_key_string(patient_id, study_id) -> str:
@@ -132,6 +223,57 @@ def get_client_public_key(patient_id, study_id) -> Crypto.PublicKey.RSA._RSAobj:
 
 
 def get_client_private_key(patient_id, study_id) -> Crypto.PublicKey.RSA._RSAobj:
-    """Grabs a user's private key file from s3."""
-    key = s3_retrieve("keys/" + patient_id +"_private", study_id)
-    return encryption.get_RSA_cipher(key)
+    """Grabs a user's private key file from s3, only on a cache miss."""
+    now = monotonic()
+    with _client_private_keys_lock:
+        cached = _client_private_keys.get(patient_id, None)
+        if cached is not None and cached[1] > now:
+            _client_private_keys.move_to_end(patient_id)
+            return cached[0]
+        generation = _client_private_key_generation(patient_id)
+
+    key = encryption.get_RSA_cipher(s3_retrieve("keys/" + patient_id +"_private", study_id))
+
+    with _client_private_keys_lock:
+        # the key pair may have been replaced while this key was being fetched.
+        if _client_private_key_generation(patient_id) != generation:
+            return key
+        _client_private_keys[patient_id] = (key, now + CLIENT_KEY_CACHE_SECONDS)
+        _client_private_keys.move_to_end(patient_id)
+        while len(_client_private_keys) > CLIENT_KEY_CACHE_SIZE:
+            _client_private_keys.popitem(last=False)
+    return key
+
+
+############################ Private Key Cache #################################
+
+# Every upload from a device is decrypted with the participant's private key, so the parsed keys
+# are cached per process, least recently used first out: {patient id: (key, expiry)}.
+# create_client_key_pair invalidates the entry of the participant in this process, the expiry
+# bounds how long other processes can hold a replaced key.  Invalidation also bumps the
+# participant's generation, {patient id: generation}, (clearing bumps every participant's) so that
+# a key that was being fetched at the time is not cached.
+_client_private_keys = OrderedDict()
+_client_private_key_generations = {}
+_client_private_keys_cleared = 0
+_client_private_keys_lock = Lock()
+
+
+def _client_private_key_generation(patient_id: str) -> (int, int):
+    """ Call with _client_private_keys_lock held. """
+    return _client_private_keys_cleared, _client_private_key_generations.get(patient_id, 0)
+
+
+def invalidate_client_private_key(patient_id: str):
+    with _client_private_keys_lock:
+        _client_private_keys.pop(patient_id, None)
+        _client_private_key_generations[patient_id] = (
+            _client_private_key_generations.get(patient_id, 0) + 1
+        )
+
+
+def clear_client_private_keys():
+    global _client_private_keys_cleared
+    with _client_private_keys_lock:
+        _client_private_keys.clear()
+        _client_private_keys_cleared += 1
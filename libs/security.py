@@ -32,8 +32,12 @@ def set_secret_key(app):
 
 def chunk_hash(data: bytes) -> bytes:
     """ We need to hash data in a data stream chunk and store the hash in mongo. """
-    digest = hashlib.md5(data).digest()
-    return codecs.encode(digest, "base64").replace(b"\n",b"")
+    return encode_chunk_hash(hashlib.md5(data))
+
+
+def encode_chunk_hash(md5) -> bytes:
+    """ The chunk_hash of data that was hashed in parts (the update()s of a hashlib.md5 object). """
+    return codecs.encode(md5.digest(), "base64").replace(b"\n",b"")
 
 
 def device_hash(data: bytes) -> bytes:
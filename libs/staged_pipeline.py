@@ -0,0 +1,107 @@
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+from typing import Callable, Generator, Iterable
+
+from django.db import connections
+
+
+class _Done(object): pass
+class _StageError(object):
+    def __init__(self, exception):
+        self.exception = exception
+
+
+# How often (seconds) blocked stage threads check whether the stage has been shut down.
+POLL_INTERVAL = 0.1
+
+
+def pipeline_stage(function: Callable, items: Iterable, concurrency: int = 1,
+                   queue_size: int = None) -> Generator:
+    """
+    Runs function over items on concurrency threads, yields the results in completion order.
+
+    Stages are chained by passing one stage's output to the next as its items, every stage then
+    runs at the same time as the stages around it.  Both ends of a stage are bounded: items are
+    pulled from the (lazy) input only as worker threads free up, and workers block once queue_size
+    results are waiting on the consumer.  A slow stage therefore applies backpressure all the way
+    up a chain of stages, which bounds the memory used by the whole pipeline.
+
+    Exceptions raised by function, or by the input iterable, are re-raised in the consumer.  If the
+    consumer stops early the stage's threads shut down, and close the input if it is a generator
+    (which shuts down any stages upstream).
+    """
+    queue_size = queue_size or concurrency
+    inputs = Queue(maxsize=concurrency)
+    outputs = Queue(maxsize=queue_size)
+    stop = Event()
+
+    def put(queue, item):
+        # a blocking put that gives up if the stage has been shut down.
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=POLL_INTERVAL)
+                return True
+            except Full:
+                continue
+        return False
+
+    def get(queue):
+        # a blocking get that returns _Done if the stage has been shut down.
+        while not stop.is_set():
+            try:
+                return queue.get(timeout=POLL_INTERVAL)
+            except Empty:
+                continue
+        return _Done
+
+    def feed():
+        try:
+            for item in items:
+                if not put(inputs, item):
+                    break
+        except Exception as e:
+            put(outputs, _StageError(e))
+        finally:
+            # The input is only ever iterated on this thread, so it is safe to close it here.
+            if hasattr(items, "close"):
+                items.close()
+            for _ in range(concurrency):
+                put(inputs, _Done)
+
+    def work():
+        try:
+            while True:
+                item = get(inputs)
+                if item is _Done:
+                    break
+                try:
+                    result = function(item)
+                except Exception as e:
+                    result = _StageError(e)
+                del item
+                if not put(outputs, result):
+                    break
+                del result
+            put(outputs, _Done)
+        finally:
+            # database connections are per-thread, close this thread's before it exits.
+            connections.close_all()
+
+    threads = [Thread(target=feed, daemon=True)]
+    threads.extend(Thread(target=work, daemon=True) for _ in range(concurrency))
+    for thread in threads:
+        thread.start()
+
+    try:
+        finished_workers = 0
+        while finished_workers < concurrency:
+            result = outputs.get()
+            if result is _Done:
+                finished_workers += 1
+            elif isinstance(result, _StageError):
+                raise result.exception
+            else:
+                yield result
+            del result
+    finally:
+        stop.set()
@@ -0,0 +1,40 @@
+import zlib
+from time import localtime, time
+from zipfile import LargeZipFile, ZIP64_LIMIT, ZIP_DEFLATED, ZipFile, ZipInfo
+
+
+def deflate_for_zip(data: bytes, level: int) -> (bytes, int, int):
+    """ Compresses data as a zip file entry, returns (compressed data, crc, size of data).
+    zlib releases the GIL, so this can run on many threads at once. """
+    # a negative window size produces the raw deflate stream that zip files contain.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(), zlib.crc32(data), len(data)
+
+
+class StreamingZipFile(ZipFile):
+    """ A ZipFile that can also write entries compressed ahead of time (see deflate_for_zip). """
+
+    def write_deflated(self, file_name: str, compressed: bytes, crc: int, file_size: int):
+        """ As writestr with ZIP_DEFLATED, but the compression has already been done.  The crc and
+        sizes are known up front, so the entry is written in one go (no data descriptor or seek
+        back to the header), as the streaming output needs. """
+        zinfo = ZipInfo(filename=file_name, date_time=localtime(time())[:6])
+        zinfo.compress_type = ZIP_DEFLATED
+        zinfo.external_attr = 0o600 << 16  # as writestr does
+        zinfo.file_size = file_size
+        zinfo.compress_size = len(compressed)
+        zinfo.CRC = crc
+
+        zip64 = file_size > ZIP64_LIMIT or zinfo.compress_size > ZIP64_LIMIT
+        if zip64 and not self._allowZip64:
+            raise LargeZipFile("Filesize would require ZIP64 extensions")
+
+        with self._lock:
+            self._writecheck(zinfo)
+            self._didModify = True
+            zinfo.header_offset = self.fp.tell()
+            self.fp.write(zinfo.FileHeader(zip64))
+            self.fp.write(compressed)
+            self.start_dir = self.fp.tell()
+            self.filelist.append(zinfo)
+            self.NameToInfo[zinfo.filename] = zinfo
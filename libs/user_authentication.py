@@ -1,8 +1,12 @@
 import functools
+import hashlib
+from threading import Lock
+from time import monotonic
 
 from flask import request, abort
 from werkzeug.datastructures import MultiDict
 
+from config.constants import PARTICIPANT_CREDENTIAL_CACHE_SECONDS, PARTICIPANT_CREDENTIAL_CACHE_SIZE
 from database.user_models import Participant
 
 
@@ -30,10 +34,8 @@ def validate_post_ignore_password(is_ios):
         or "device_id" not in request.values):
         return False
 
-    participant_set = Participant.objects.filter(patient_id=request.values['patient_id'])
-    if not participant_set.exists():
+    if not Participant.objects.filter(patient_id=request.values['patient_id']).exists():
         return False
-    participant = participant_set.get()
     # Disabled
     # if not participant.validate_password(request.values['password']):
     #     return False
@@ -71,11 +73,10 @@ def validate_post():
             or "password" not in request.values
             or "device_id" not in request.values):
         return False
-    participant_set = Participant.objects.filter(patient_id=request.values['patient_id'])
-    if not participant_set.exists():
+    participant = Participant.objects.filter(patient_id=request.values['patient_id']).first()
+    if participant is None:
         return False
-    participant = participant_set.get()
-    if not participant.validate_password(request.values['password']):
+    if not validate_participant_password(participant):
         return False
     if not participant.device_id == request.values['device_id']:
         return False
@@ -105,15 +106,58 @@ def validate_registration():
             or "password" not in request.values
             or "device_id" not in request.values):
         return False
-    participant_set = Participant.objects.filter(patient_id=request.values['patient_id'])
-    if not participant_set.exists():
+    participant = Participant.objects.filter(patient_id=request.values['patient_id']).first()
+    if participant is None:
         return False
-    participant = participant_set.get()
-    if not participant.validate_password(request.values['password']):
+    if not validate_participant_password(participant):
         return False
     return True
 
 
+####################################################################################################
+
+# Validating a password hashes it with PBKDF2 (ITERATIONS times), and devices send their credentials
+# with every request, so credentials that validated are cached per process:
+# {(patient id, device id, sha256 of the supplied password): (the participant's password hash, expiry)}
+# An entry only applies while the participant's password hash is unchanged, so a password changed by
+# another process invalidates it too.  Participant.set_password and clear_device drop the
+# participant's entries from the cache of the process they run in.
+_verified_credentials = {}
+_verified_credentials_lock = Lock()
+
+
+def validate_participant_password(participant: Participant) -> bool:
+    """ Checks the password in the request against the participant's, skipping the hashing if these
+    credentials were already validated. """
+    password = request.values['password']
+    cache_key = (
+        participant.patient_id, request.values['device_id'], hashlib.sha256(password.encode()).digest()
+    )
+    now = monotonic()
+    with _verified_credentials_lock:
+        cached = _verified_credentials.get(cache_key, None)
+    if cached is not None and cached[1] > now and cached[0] == participant.password:
+        return True
+
+    if not participant.validate_password(password):
+        return False
+
+    with _verified_credentials_lock:
+        if len(_verified_credentials) >= PARTICIPANT_CREDENTIAL_CACHE_SIZE:
+            for key in [key for key, (_, expiry) in _verified_credentials.items() if expiry <= now]:
+                del _verified_credentials[key]
+            if len(_verified_credentials) >= PARTICIPANT_CREDENTIAL_CACHE_SIZE:
+                _verified_credentials.clear()
+        _verified_credentials[cache_key] = (participant.password, now + PARTICIPANT_CREDENTIAL_CACHE_SECONDS)
+    return True
+
+
+def invalidate_participant_credentials(patient_id: str):
+    with _verified_credentials_lock:
+        for key in [key for key in _verified_credentials if key[0] == patient_id]:
+            del _verified_credentials[key]
+
+
 def correct_for_basic_auth():
     """
     Basic auth is used in IOS.
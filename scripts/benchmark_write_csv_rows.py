@@ -0,0 +1,113 @@
+from os.path import abspath as _abspath
+from sys import path as _path
+_one_folder_up = _abspath(__file__).rsplit('/',2)[0]
+_path.insert(1, _one_folder_up)
+
+import random
+from sys import argv
+from time import perf_counter
+
+from config import load_django
+from libs.file_processing import merge_sorted_csv_rows, write_csv_rows
+
+DOCUMENTATION = """
+Micro-benchmark of the construction of chunk csvs in file processing (see
+libs.file_processing.build_chunk_contents): libs.file_processing.merge_sorted_csv_rows into
+write_csv_rows, against the previous construct_csv_string, on synthetic hours of accelerometer data
+(100k and 1M rows, ~1% duplicate rows).  A new chunk is a single sorted list of rows, the rows of
+an existing chunk are merged with the new rows as a second sorted list.
+
+The previous implementation is quadratic in the number of rows, on a 1M-row hour it runs for a
+very long time; it is only run on the 1M-row hour when this script is given the argument "--full".
+""".strip()
+
+ACCELEROMETER_HEADER = b"timestamp,UTC time,accuracy,x,y,z"
+HOUR_START_MILLISECONDS = 1546300800000
+ROW_COUNTS = [100000, 1000000]
+LEGACY_ROW_LIMIT = 100000
+
+
+def build_new_chunk(header: bytes, rows_list: list) -> bytes:
+    """ The chunk csv of rows that are not in a chunk yet. """
+    return write_csv_rows(header, merge_sorted_csv_rows(rows_list)).getvalue()
+
+
+def build_merged_chunk(header: bytes, rows_list: list) -> bytes:
+    """ The chunk csv of rows half of which (every other row) are in an existing chunk. """
+    return write_csv_rows(header, merge_sorted_csv_rows(rows_list[::2], rows_list[1::2])).getvalue()
+
+
+def legacy_construct_csv_string(header: bytes, rows_list: list) -> bytes:
+    """ The previous construct_csv_string, verbatim except for the debugging print statements. """
+    def deduplicate(seq):
+        seen = set()
+        seen_add = seen.add
+        return [x for x in seq if not (x in seen or seen_add(x))]
+
+    rows = []
+    for row_items in rows_list:
+        rows.append(b",".join(row_items))
+
+    rows = deduplicate(rows)
+    ret = header
+    for row in rows:
+        ret += b"\n" + row
+    return ret
+
+
+def synthetic_accelerometer_hour(row_count: int) -> list:
+    """ Rows look like real accelerometer rows, timestamps are spread over a single hour. """
+    rng = random.Random(row_count)
+    step = 3600 * 1000 / row_count
+    rows = []
+    for i in range(row_count):
+        timestamp = HOUR_START_MILLISECONDS + int(i * step)
+        rows.append([
+            b"%d" % timestamp,
+            b"2019-01-01T00:%02d:%02d.%03d" % (i * 60 // row_count, (i * 3600 // row_count) % 60, timestamp % 1000),
+            b"unknown",
+            b"%.6f" % rng.uniform(-2, 2),
+            b"%.6f" % rng.uniform(-2, 2),
+            b"%.6f" % rng.uniform(8, 11),
+        ])
+    # sprinkle in duplicate rows, as happen when the same data file is uploaded twice.
+    for i in rng.sample(range(row_count), row_count // 100):
+        rows.insert(i, list(rows[i]))
+    return rows
+
+
+def time_it(function, rows) -> (float, bytes):
+    # the row lists are copied so that every function is given the same, unmodified, rows.
+    rows = [list(row) for row in rows]
+    start = perf_counter()
+    output = function(ACCELEROMETER_HEADER, rows)
+    return perf_counter() - start, output
+
+
+def main():
+    full = "--full" in argv
+    print(DOCUMENTATION, "\n")
+
+    for row_count in ROW_COUNTS:
+        rows = synthetic_accelerometer_hour(row_count)
+        new_seconds, new_output = time_it(build_new_chunk, rows)
+        merged_seconds, merged_output = time_it(build_merged_chunk, rows)
+        print("%s rows (%.1fMB csv):" % (row_count, len(new_output) / 1024 / 1024))
+        print("\tnew chunk:                   %.3fs" % new_seconds)
+        print("\tmerged chunk:                %.3fs" % merged_seconds)
+        if merged_output != new_output:
+            raise Exception("the merged chunk differs from the new chunk.")
+
+        if row_count > LEGACY_ROW_LIMIT and not full:
+            print("\tlegacy_construct_csv_string: skipped (run with --full)")
+            continue
+
+        legacy_seconds, legacy_output = time_it(legacy_construct_csv_string, rows)
+        print("\tlegacy_construct_csv_string: %.3fs" % legacy_seconds)
+        print("\tspeedup: %.1fx" % (legacy_seconds / new_seconds))
+        if legacy_output != new_output:
+            raise Exception("the chunk csv differs from the previous implementation.")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,7 +8,7 @@ from config import load_django
 
 from kombu.exceptions import OperationalError
 from celery import Celery, states
-from celery.states import SUCCESS
+from celery.signals import worker_process_init
 
 STARTED_OR_WAITING = [states.PENDING, states.RECEIVED, states.STARTED]
 
@@ -41,17 +41,33 @@ except IOError:
 ################################################################################
 ############################# Data Processing ##################################
 ################################################################################
+from sys import argv
 from time import sleep
 from datetime import datetime, timedelta
 
-from config.constants import FILE_PROCESS_PAGE_SIZE, CELERY_EXPIRY_MINUTES, CELERY_ERROR_REPORT_TIMEOUT_SECONDS
-from database.data_access_models import FileProcessLock
+from django.db.models import Count, Min
+from django.utils import timezone
+
+from config.constants import (FILE_PROCESS_PAGE_SIZE, CELERY_EXPIRY_MINUTES, CELERY_ERROR_REPORT_TIMEOUT_SECONDS,
+    FILE_PROCESS_LEASE_SECONDS, FILE_PROCESS_SCHEDULER_INTERVAL_SECONDS, FILE_PROCESS_STRAGGLER_MINUTES,
+    FILE_PROCESS_TASKS_PER_WORKER, PRELOAD_STUDY_KEYS_ON_WORKER_START)
+from database.data_access_models import FileProcessLock, FileToProcess, ParticipantProcessingLease
 from database.user_models import Participant
-from libs.file_processing import ProcessingOverlapError, do_process_user_file_chunks
+from libs.encryption import preload_study_encryption_keys
+from libs.file_processing import (ParticipantLease, ProcessingOverlapError, close_cpu_pool,
+    do_process_user_file_chunks, get_cpu_pool)
 from libs.logging import email_system_administrators
 from libs.sentry import make_error_sentry
 
 
+@worker_process_init.connect
+def preload_worker_study_keys(**kwargs):
+    """ Every file downloaded or uploaded during processing is decrypted or encrypted with a study
+    key, loading them all up front means the S3 operations make no database queries. """
+    if PRELOAD_STUDY_KEYS_ON_WORKER_START:
+        preload_study_encryption_keys()
+
+
 @celery_app.task
 def queue_user(participant):
     return celery_process_file_chunks(participant)
@@ -85,24 +101,28 @@ def create_file_processing_tasks():
     with make_error_sentry('data') as error_sentry:
         print(error_sentry.sentry_client.is_enabled())
         if FileProcessLock.islocked():
-            # This is really a safety check to ensure that no code executes
-            # if file processing is locked.
+            # This is really a safety check to ensure that no code executes while data is being
+            # reindexed (see libs.file_processing_utils).
             report_file_processing_locked_and_exit()
             # report_file_processing_locked should raise an error; this should be unreachable
             exit(0)
-        else:
-            FileProcessLock.lock()
             
         print("starting.")
         now = datetime.now()
         expiry = now + timedelta(minutes=CELERY_EXPIRY_MINUTES)
-        participant_set = Participant.objects.filter(files_to_process__isnull=False).distinct().values_list("id", flat=True)
-        running = []
+        # Processing is guarded per participant by a lease (see ParticipantLease).  Participants
+        # that are currently being processed are not queued again, the worker processing them
+        # continues until it runs out of files.  Everyone else is queued right away, whether or not
+        # the participants of a previous run are still being processed.
+        leased_participants = ParticipantProcessingLease.active().values_list("participant_id", flat=True)
+        participant_set = (
+            Participant.objects.filter(files_to_process__isnull=False)
+            .exclude(id__in=leased_participants).distinct().values_list("id", flat=True)
+        )
+        queued = []
         
         for participant_id in participant_set:
-            # Queue all users' file processing, and generate a list of currently running jobs
-            # to use to detect when all jobs are finished running.
-            running.append(safe_queue_user(
+            queued.append(safe_queue_user(
                 args=[participant_id],
                 max_retries=0,
                 expires=expiry,
@@ -111,35 +131,117 @@ def create_file_processing_tasks():
                 retry=False
             ))
             
-        print("tasks:", running)
-        
-        # If there are any Celery tasks still running, check their state and update the running
-        # list accordingly. Do this every 5 seconds.
-        while running:
-            new_running = []
-            failed = []
-            successful = []
-            for future in running:
-                ####################################################################################
-                # This variable can mutate on a separate thread.  We need the value as it was at
-                # this snapshot in time, so we store it.  (The object is a string, passed by value.)
-                ####################################################################################
-                state = future.state
-                if state == SUCCESS:
-                    successful.append(future)
-                if state in FAILED:
-                    failed.append(future)
-                if state in STARTED_OR_WAITING:
-                    new_running.append(future)
-                
-            running = new_running
-            print("tasks:", running)
-            if running:
-                sleep(5)
-                
-        print("Finished, unlocking.")
-        # The unlocking MUST be **inside** the with statement.
-        FileProcessLock.unlock()
+        print("tasks:", queued)
+        report_long_running_leases()
+
+
+def run_file_processing_scheduler():
+    """
+    The long running alternative to create_file_processing_tasks (run this file with the argument
+    --scheduler instead of running it from cron).  Every FILE_PROCESS_SCHEDULER_INTERVAL_SECONDS
+    it queues participants with files to process, so new uploads are processed within minutes
+    rather than in the next hourly run.
+    """
+    # participant id: (the AsyncResult of the participant's task, when it was queued)
+    in_flight = {}
+    while True:
+        with make_error_sentry('data'):
+            schedule_file_processing_tasks(in_flight)
+        sleep(FILE_PROCESS_SCHEDULER_INTERVAL_SECONDS)
+
+
+def schedule_file_processing_tasks(in_flight: dict):
+    """ One round of run_file_processing_scheduler.  Keeps up to FILE_PROCESS_TASKS_PER_WORKER
+    participants queued or running per celery worker, the participants whose files have waited
+    longest, and of those the ones with the most files to process go first. """
+    if FileProcessLock.islocked():
+        print("data is being reindexed, not scheduling.")
+        return
+
+    now = timezone.now()
+    leased_participants = set(ParticipantProcessingLease.active().values_list("participant_id", flat=True))
+    straggler_cutoff = now - timedelta(minutes=FILE_PROCESS_STRAGGLER_MINUTES)
+    dead_cutoff = now - timedelta(seconds=FILE_PROCESS_LEASE_SECONDS)
+
+    for participant_id, (future, queued_time) in list(in_flight.items()):
+        ####################################################################################
+        # This variable can mutate on a separate thread.  We need the value as it was at
+        # this snapshot in time, so we store it.  (The object is a string, passed by value.)
+        ####################################################################################
+        state = future.state
+        if state not in STARTED_OR_WAITING:
+            # finished, or failed.  If there are files left the participant will be queued again.
+            del in_flight[participant_id]
+        elif state != states.STARTED and queued_time < straggler_cutoff:
+            # Stragglers: tasks that are stuck in the queue (e.g. behind a long running task on a
+            # worker that prefetched them) are revoked and queued again, to be picked up by
+            # whichever worker is free.
+            print("requeueing straggler", participant_id)
+            future.revoke()
+            del in_flight[participant_id]
+        elif (state == states.STARTED and participant_id not in leased_participants
+              and queued_time < dead_cutoff):
+            # The task started but holds no lease, its worker died.  (If the participant is queued
+            # again while the task is in fact alive, the lease stops the second task.)
+            print("dropping dead task", participant_id)
+            del in_flight[participant_id]
+
+    workers = celery_app.control.ping(timeout=1) or []
+    capacity = max(len(workers), 1) * FILE_PROCESS_TASKS_PER_WORKER - len(in_flight)
+    if capacity <= 0:
+        return
+
+    backlogs = (
+        FileToProcess.objects.filter(deleted=False)
+        .exclude(participant_id__in=leased_participants.union(in_flight))
+        .values("participant_id").annotate(backlog=Count("id"), oldest=Min("created_on"))
+    )
+    # Participants are ordered by how long their oldest file has waited, in steps of the scheduler
+    # interval; within a step participants with larger backlogs go first.
+    interval = timedelta(seconds=FILE_PROCESS_SCHEDULER_INTERVAL_SECONDS)
+    backlogs = sorted(backlogs, key=lambda b: ((b["oldest"] - now) // interval, -b["backlog"]))
+
+    for backlog in backlogs[:capacity]:
+        participant_id = backlog["participant_id"]
+        in_flight[participant_id] = (
+            safe_queue_user(
+                args=[participant_id],
+                max_retries=0,
+                expires=datetime.now() + timedelta(minutes=FILE_PROCESS_STRAGGLER_MINUTES),
+                task_track_started=True,
+                task_publish_retry=False,
+                retry=False
+            ),
+            now,
+        )
+        print("queued %s, %s files waiting since %s" % (participant_id, backlog["backlog"], backlog["oldest"]))
+
+
+def report_long_running_leases():
+    """ Creates a useful error report about participants that have been processing for a long time. """
+    now = timezone.now()
+    long_running = list(
+        ParticipantProcessingLease.active()
+        .filter(lock_time__lt=now - timedelta(seconds=CELERY_ERROR_REPORT_TIMEOUT_SECONDS))
+        .values_list("participant__patient_id", "lock_time")
+    )
+    if not long_running:
+        return
+
+    error_msg = "Data processing of %s participant(s) has been running for more than %s minutes:" % (
+        len(long_running), CELERY_ERROR_REPORT_TIMEOUT_SECONDS / 60
+    )
+    for patient_id, lock_time in long_running:
+        running_seconds = (now - lock_time).total_seconds()
+        error_msg += "\n%s has been processing for %s hour(s), %s minute(s)" % (
+            patient_id, str(int(running_seconds / 60 / 60)), str(int(running_seconds / 60 % 60))
+        )
+
+    longest_seconds = max((now - lock_time).total_seconds() for _, lock_time in long_running)
+    if longest_seconds > CELERY_ERROR_REPORT_TIMEOUT_SECONDS * 4:
+        error_msg = "DATA PROCESSING OVERLOADED, CHECK SERVER.\n" + error_msg
+        email_system_administrators(error_msg, "DATA PROCESSING OVERLOADED, CHECK SERVER")
+    raise ProcessingOverlapError(error_msg)
 
 
 def report_file_processing_locked_and_exit():
@@ -180,37 +282,49 @@ def celery_process_file_chunks(participant_id):
     This runs automatically and periodically as a Celery task.
     """
     participant = Participant.objects.get(id=participant_id)
+    lease = ParticipantLease(participant.pk)
+    if not lease.acquire():
+        # This participant is already being processed by another worker, which will also process
+        # any files that were uploaded since it started.
+        print("%s is being processed elsewhere, skipping." % participant.patient_id)
+        return
+
     log = LogList()
     number_bad_files = 0
     tags = {'user_id': participant.patient_id}
     error_sentry = make_error_sentry('data', tags=tags)
     log.append("processing files for %s" % participant.patient_id)
-    
-    while True:
-        previous_number_bad_files = number_bad_files
-        starting_length = participant.files_to_process.exclude(deleted=True).count()
-        
-        log.append("%s processing %s, %s files remaining" % (datetime.now(), participant.patient_id, starting_length))
-        number_bad_files += do_process_user_file_chunks(
-                count=FILE_PROCESS_PAGE_SIZE,
-                error_handler=error_sentry,
-                skip_count=number_bad_files,
-                participant=participant,
-        )
-        
-        # If no files were processed, quit processing
-        if participant.files_to_process.exclude(deleted=True).count() == starting_length:
-            if previous_number_bad_files == number_bad_files:
-                # Cases:
-                #   every file broke, blow up. (would cause infinite loop otherwise)
-                #   no new files.
-                break
-            else:
-                continue
-                
+
+    # The process pool has to be created before the thread of the lease is, it lasts for this task.
+    get_cpu_pool()
+    try:
+        with lease:
+            last_id = 0
+            while True:
+                lease.check()
+                log.append("%s processing %s" % (datetime.now(), participant.patient_id))
+                # Files that failed are skipped, later pages start after the last file of this one.
+                page_bad_files, last_id = do_process_user_file_chunks(
+                        count=FILE_PROCESS_PAGE_SIZE,
+                        error_handler=error_sentry,
+                        after_id=last_id,
+                        participant=participant,
+                        lease=lease,
+                )
+                number_bad_files += page_bad_files
+
+                # If there are no files left (that have not already failed), quit processing
+                if last_id is None:
+                    break
+    finally:
+        close_cpu_pool()
+
     with make_error_sentry('data', tags=tags):
         error_sentry.raise_errors()
 
 
 if __name__ == "__main__":
-    create_file_processing_tasks()
+    if "--scheduler" in argv:
+        run_file_processing_scheduler()
+    else:
+        create_file_processing_tasks()
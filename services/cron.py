@@ -7,6 +7,7 @@ path.insert(0, abspath(__file__).rsplit('/', 2)[0])
 from sys import argv
 from cronutils import run_tasks
 from services.celery_data_processing import create_file_processing_tasks
+from libs.export_archives import build_export_archives
 from pipeline import index
 
 FIVE_MINUTES = "five_minutes"
@@ -30,7 +31,7 @@ VALID_ARGS = [FIVE_MINUTES, HOURLY, FOUR_HOURLY, DAILY, WEEKLY, MONTHLY]
 TASKS = {
     FIVE_MINUTES: [create_file_processing_tasks],
     HOURLY: [index.hourly],
-    FOUR_HOURLY: [],
+    FOUR_HOURLY: [build_export_archives],
     DAILY: [index.daily],
     WEEKLY: [index.weekly],
     MONTHLY: [index.monthly],